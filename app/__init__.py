@@ -1,16 +1,17 @@
 from config import Config
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
-import logging
-from logging.handlers import SMTPHandler
-from logging.handlers import RotatingFileHandler
-import os
 from flask_moment import Moment
 from flask_bootstrap import Bootstrap
 from flask_wtf import CSRFProtect
-from elasticsearch import Elasticsearch
+from .assets import Assets
+from .database import RoutingSQLAlchemy
+from .last_seen import LastSeenTracker
+from .log import init_logging
+from .metrics import Metrics
+from .passwords import PasswordHasher
+from .search import create_backend
 
 # app = Flask(__name__)
 # db = SQLAlchemy(app)
@@ -20,7 +21,7 @@ from elasticsearch import Elasticsearch
 # bootstrap = Bootstrap(app)
 # moment = Moment(app)
 # csrf = CSRFProtect(app)
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 login = LoginManager()
 login.login_message = 'Please log in to access this message.'
@@ -28,18 +29,44 @@ login.login_view = 'auth.login'
 bootstrap = Bootstrap()
 moment = Moment()
 csrf = CSRFProtect()
+last_seen = LastSeenTracker()
+passwords = PasswordHasher()
+metrics = Metrics()
+assets = Assets()
+
+from .indexer import SearchIndexer
+from .chip_cache import ChipCache
+from .fragments import PageCache
+search_indexer = SearchIndexer()
+chip_cache = ChipCache()
+page_cache = PageCache()
+
+from .stream import TimelineStream
+from .jobs import JobQueue
+stream = TimelineStream()
+jobs = JobQueue()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+    app.elasticsearch = None  # built on first use, see search_backends.elasticsearch_client
+    app.search_backend = create_backend(app)
     db.init_app(app)
     migrate.init_app(app)
     login.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     csrf.init_app(app)
+    last_seen.init_app(app)
+    passwords.init_app(app)
+    metrics.init_app(app)
+    assets.init_app(app)
+    search_indexer.init_app(app)
+    chip_cache.init_app(app)
+    page_cache.init_app(app)
+    stream.init_app(app)
+    jobs.init_app(app)
 
     # register errors blueprint
     from .errors import bp as errors_bp
@@ -53,32 +80,12 @@ def create_app(config_class=Config):
     from .main import bp as main_bp
     app.register_blueprint(main_bp)
 
-    if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-        if not os.path.exists('logs'):
-            os.makedirs('logs')
-        file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=10240, backupCount=10)
-        file_handler.setFormatter(
-            logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+    # register cli blueprint
+    from .cli import bp as cli_bp
+    app.register_blueprint(cli_bp)
 
-        app.logger.setLevel(logging.INFO)
+    if not app.debug and not app.testing:
+        init_logging(app)
         app.logger.info('Microblog startup')
 
     return app
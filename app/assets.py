@@ -0,0 +1,198 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+from flask import current_app, request, send_from_directory
+
+STATIC_REFERENCE = re.compile(r'''url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*['"]([^'"]+)['"]''')
+CSS_URL = re.compile(r'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^'")\s]+))\s*\)''')
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.ttf', '.eot', '.json', '.txt', '.html'}
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def _minified(static_folder, name):
+    """``x.min.css`` for ``x.css`` when it exists, so only one copy of the file is shipped."""
+    stem, ext = posixpath.splitext(name)
+    if ext in ('.css', '.js') and not stem.endswith('.min') and \
+            os.path.isfile(os.path.join(static_folder, stem + '.min' + ext)):
+        return stem + '.min' + ext
+    return name
+
+
+def _compress(path, data, min_size):
+    """Write .gz and, when the brotli package is installed, .br next to ``path``; returns the suffixes kept."""
+    kept = []
+    if len(data) < min_size:
+        return kept
+    variants = [('.gz', lambda: gzip.compress(data, 9, mtime=0))]
+    try:
+        import brotli
+        variants.insert(0, ('.br', lambda: brotli.compress(data, quality=11)))
+    except ImportError:
+        pass
+    for suffix, compress in variants:
+        compressed = compress()
+        # not worth a second request path for a few percent
+        if len(compressed) < 0.9 * len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            kept.append(suffix)
+    return kept
+
+
+def template_folders(app):
+    """The template folders of the app and its blueprints."""
+    folders = list(app.jinja_loader.searchpath)
+    for blueprint in app.blueprints.values():
+        if blueprint.template_folder:
+            folders.append(os.path.join(blueprint.root_path, blueprint.template_folder))
+    return folders
+
+
+def referenced(template_folders, include=()):
+    """Static filenames named in ``url_for('static', filename=...)`` calls of the templates."""
+    names = set(include)
+    for folder in template_folders:
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                with open(os.path.join(root, name), encoding='utf-8', errors='replace') as f:
+                    names.update(STATIC_REFERENCE.findall(f.read()))
+    return names
+
+
+def build(static_folder, template_folders, output, include=(), min_size=512):
+    """Collect the static files the templates use into ``output``.
+
+    Each file is stored under a name holding a hash of its content, CSS
+    ``url()`` references are rewritten to the hashed names of their targets,
+    and compressible files get precompressed siblings. Files nothing refers
+    to, source maps and unminified copies of minified files are left out.
+    ``manifest.json`` maps every requested name to its hashed one.
+    """
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    os.makedirs(output)
+    files, encodings, stored, collecting = {}, {}, {}, set()
+
+    def collect(name):
+        if name in files:
+            return files[name]
+        if name in collecting:
+            # stylesheets that refer to each other keep the plain name for the back reference
+            return None
+        source = _minified(static_folder, name)
+        path = os.path.join(static_folder, *source.split('/'))
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        if source.endswith('.css'):
+            collecting.add(name)
+            try:
+                data = rewrite_css(data, posixpath.dirname(source), collect)
+            finally:
+                collecting.discard(name)
+        stem, ext = posixpath.splitext(source)
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        # identical files are stored once
+        hashed = stored.setdefault(digest, '{}.{}{}'.format(stem, digest, ext))
+        target = os.path.join(output, *hashed.split('/'))
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            if ext in COMPRESSIBLE:
+                encodings[hashed] = _compress(target, data, min_size)
+        files[name] = hashed
+        return hashed
+
+    for name in sorted(referenced(template_folders, include)):
+        collect(name)
+    manifest = {'files': files, 'encodings': {name: kept for name, kept in encodings.items() if kept}}
+    with open(os.path.join(output, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def rewrite_css(data, directory, collect):
+    """Point the ``url()`` references of a stylesheet at the hashed names ``collect`` returns."""
+    text = data.decode('utf-8')
+
+    def replace(match):
+        double, single, bare = match.groups()
+        url = double if double is not None else single if single is not None else bare
+        quote = '"' if double is not None else "'" if single is not None else ''
+        if re.match(r'^(data:|[a-z]+://|//|/)', url):
+            return match.group(0)
+        path, suffix = re.match(r'^([^?#]*)(.*)$', url).groups()
+        hashed = collect(posixpath.normpath(posixpath.join(directory, path)))
+        if hashed is None:
+            return match.group(0)
+        relative = posixpath.relpath(hashed, directory or '.')
+        return 'url({0}{1}{2}{0})'.format(quote, relative, suffix)
+
+    return CSS_URL.sub(replace, text).encode('utf-8')
+
+
+class Assets(object):
+    """Serves the output of ``flask assets build`` in place of app/static.
+
+    When ASSETS_BUILD_DIR holds a manifest, ``url_for('static', ...)`` emits
+    the hashed names, which are served with far-future immutable caching and
+    as their .br or .gz variant when the browser accepts it. Names not in the
+    manifest, and everything when there is no build, come from app/static as
+    before.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.load(app)
+        app.url_defaults(self._hashed_name)
+        if 'static' in app.view_functions:
+            app.view_functions['static'] = self._serve
+
+    @staticmethod
+    def load(app):
+        """Read the manifest of the last build, if there is one."""
+        path = os.path.join(app.config['ASSETS_BUILD_DIR'], 'manifest.json')
+        manifest = {'files': {}, 'encodings': {}}
+        if os.path.isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        manifest['hashed'] = set(manifest['files'].values())
+        app.extensions['assets'] = manifest
+
+    @staticmethod
+    def _hashed_name(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            files = current_app.extensions['assets']['files']
+            values['filename'] = files.get(values['filename'], values['filename'])
+
+    @staticmethod
+    def _serve(filename):
+        manifest = current_app.extensions['assets']
+        if filename not in manifest['hashed']:
+            return current_app.send_static_file(filename)
+        served, encoding = filename, None
+        for name, suffix in ENCODINGS:
+            # a quality of 0 refuses the encoding
+            if suffix in manifest['encodings'].get(filename, ()) and request.accept_encodings[name] > 0:
+                served, encoding = filename + suffix, name
+                break
+        max_age = current_app.config['ASSETS_MAX_AGE']
+        response = send_from_directory(current_app.config['ASSETS_BUILD_DIR'], served, conditional=True,
+                                       mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                       cache_timeout=max_age)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if manifest['encodings'].get(filename):
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(max_age)
+        return response
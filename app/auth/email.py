@@ -1,29 +1,127 @@
 from flask import render_template, flash, current_app  # from_email = current_app.config['ADMINS'][0]
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import From, To, PlainTextContent, HtmlContent, Mail
-import os
-from threading import Thread
+from werkzeug.utils import import_string
+from .. import db, jobs
+from ..jobs import PermanentError
+
+
+def _failure(e):
+    # rate limits, server and network errors are worth another try, the rest is not
+    status = getattr(e, 'status_code', None)
+    if status is not None and status != 429 and status < 500:
+        return PermanentError('SendGrid refused the message: {}'.format(status))
+    return e
+
+
+class SendGridTransport(object):
+    """Sends through one SendGrid client, reused for every message.
+
+    It is built by the first send, which is when ``sendgrid`` is imported.
+    A batch goes out as one API request per sender, with a personalization
+    for each message whose subject and bodies are filled in by
+    substitution; messages too large for that are sent on their own.
+    """
+
+    # SendGrid's limits per request and on the substitutions of one personalization
+    max_personalizations = 1000
+    max_substitution_bytes = 10000
+
+    def __init__(self, app):
+        from sendgrid import SendGridAPIClient
+        self.client = SendGridAPIClient(api_key=app.config['SENDGRID_API_KEY'])
+        self.client.client.timeout = app.config['MAIL_SEND_TIMEOUT']
+
+    def send(self, message):
+        from sendgrid.helpers.mail import From, To, PlainTextContent, HtmlContent, Mail
+        mail = Mail(From(message['from']), To(message['to']), message['subject'],
+                    PlainTextContent(message['text']), HtmlContent(message['html']))
+        try:
+            self.client.send(message=mail)
+        except Exception as e:
+            raise _failure(e)
+
+    def _fits(self, message):
+        return len(message['text'].encode('utf-8')) + len(message['html'].encode('utf-8')) <= \
+            self.max_substitution_bytes
+
+    def send_batch(self, messages):
+        """Send ``messages``; returns None or the exception for each of them."""
+        results = [None] * len(messages)
+        groups = {}
+        for i, message in enumerate(messages):
+            if self._fits(message):
+                groups.setdefault(message['from'], []).append(i)
+                continue
+            try:
+                self.send(message)
+            except Exception as e:
+                results[i] = e
+        for sender, indexes in groups.items():
+            for start in range(0, len(indexes), self.max_personalizations):
+                chunk = indexes[start:start + self.max_personalizations]
+                body = {
+                    'from': {'email': sender},
+                    'content': [{'type': 'text/plain', 'value': '-text-'}, {'type': 'text/html', 'value': '-html-'}],
+                    'personalizations': [{
+                        'to': [{'email': messages[i]['to']}], 'subject': messages[i]['subject'],
+                        'substitutions': {'-text-': messages[i]['text'], '-html-': messages[i]['html']}}
+                        for i in chunk]}
+                try:
+                    self.client.send(message=body)
+                except Exception as e:
+                    for i in chunk:
+                        results[i] = _failure(e)
+        return results
+
+
+class FakeTransport(object):
+    """Keeps messages in ``outbox`` instead of sending them, for tests."""
+
+    def __init__(self, app):
+        self.outbox = []
+
+    def send(self, message):
+        self.outbox.append(message)
+
+
+TRANSPORTS = {
+    'sendgrid': SendGridTransport,
+    'fake': FakeTransport,
+}
+
+
+def transport():
+    app = current_app._get_current_object()
+    if 'mail_transport' not in app.extensions:
+        name = app.config['MAIL_TRANSPORT']
+        app.extensions['mail_transport'] = (TRANSPORTS[name] if name in TRANSPORTS else import_string(name))(app)
+    return app.extensions['mail_transport']
+
+
+@jobs.handler('email')
+def send_emails(messages):
+    sender = transport()
+    if hasattr(sender, 'send_batch'):
+        return sender.send_batch(messages)
+    results = []
+    for message in messages:
+        try:
+            sender.send(message)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def send_email(to, subject, text, html, sender='zhou_cba@163.com'):
+    """Queue an email; it is sent by a job worker after the next commit."""
+    jobs.enqueue('email', {'from': sender, 'to': to, 'subject': subject, 'text': text, 'html': html})
 
 
 # send mail with SendGrip
 def send_api_mail_async(user):
     token = user.get_reset_password_token()
-    from_email = From('zhou_cba@163.com')
-    to_email = To(user.email)
-    subject = '[Microblog] Reset Your Password'
-    plain_text_content = PlainTextContent(render_template('email/reset_password.txt',
-                                                          user=user, token=token)
-                                          )
-    html_content = HtmlContent(render_template('email/reset_password.html',
-                                               user=user, token=token))
-    message = Mail(from_email, to_email, subject,
-                   plain_text_content, html_content)
-    Thread(target=send_api_mail, args=(message,)).start()
+    send_email(user.email, '[Microblog] Reset Your Password',
+               render_template('email/reset_password.txt', user=user, token=token),
+               render_template('email/reset_password.html', user=user, token=token))
+    db.session.commit()
     flash('Email Sent!')
-
-
-def send_api_mail(message):
-    sendgrid_client = SendGridAPIClient(
-        api_key=os.environ.get('SENDGRID_API_KEY'))
-    # with app.app_context():
-    sendgrid_client.send(message=message)
@@ -0,0 +1,242 @@
+import json
+from bisect import bisect_left
+from threading import Lock
+from time import time
+from flask import current_app
+from sqlalchemy import func, select
+from app import db
+from app.cache import LRUCache
+from app.pagination import forget_counts
+
+# Bumped for a work order or approval number whenever chips move to or from
+# it. The version is part of every cached page's key, so every process stops
+# using the pages cached before the change.
+chipid_versions = db.Table('chipid_versions',
+                           db.Column('value', db.String(20), primary_key=True),
+                           db.Column('version', db.Integer, nullable=False)
+                           )
+
+
+class RedisCache(object):
+    """Cache shared by every process, in Redis with values stored as JSON."""
+
+    def __init__(self, url, ttl, prefix='microblog:chipid:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or self.ttl)
+
+
+class NumberIndex(object):
+    """The numbers of a dimension table sorted as they are and reversed.
+
+    A prefix is found by bisecting the sorted numbers and a suffix by
+    bisecting the reversed ones for the reversed suffix, so a match costs
+    O(log n) plus the matches returned.
+    """
+
+    def __init__(self, values, max_id, count):
+        self.values = sorted(values)
+        self.reversed = sorted(value[::-1] for value in self.values)
+        self.max_id = max_id
+        self.count = count
+        self.checked = time()
+
+    def extended(self, values, max_id, count):
+        """A new index with ``values`` added."""
+        index = NumberIndex((), max_id, count)
+        index.values = sorted(self.values + list(values))
+        index.reversed = sorted(self.reversed + [value[::-1] for value in values])
+        return index
+
+    @staticmethod
+    def _starting(keys, text, limit):
+        found = []
+        i = bisect_left(keys, text)
+        while i < len(keys) and len(found) < limit and keys[i].startswith(text):
+            found.append(keys[i])
+            i += 1
+        return found
+
+    def match(self, text, limit):
+        """``text`` if it is a number, else up to ``limit`` numbers ending with it, else starting with it."""
+        i = bisect_left(self.values, text)
+        if i < len(self.values) and self.values[i] == text:
+            return [text]
+        found = sorted(value[::-1] for value in self._starting(self.reversed, text[::-1], limit))
+        return found or self._starting(self.values, text, limit)
+
+
+class ResultCache(object):
+    """The chip query cache of one application.
+
+    Pages are kept in an in-process LRU and, when CHIPID_CACHE_URL is set, in
+    a shared cache behind it. Invalidating a work order or approval number
+    drops the local entries for it and bumps its row in ``chipid_versions``;
+    the version is part of every key, so the other processes miss once they
+    next read it, at most CHIPID_VERSION_CHECK_INTERVAL seconds later.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        ttl = app.config['CHIPID_CACHE_TTL']
+        self.local = LRUCache(app.config['CHIPID_CACHE_SIZE'], ttl)
+        self.shared = RedisCache(app.config['CHIPID_CACHE_URL'], ttl) if app.config['CHIPID_CACHE_URL'] else None
+        self.versions = LRUCache(app.config['CHIPID_CACHE_SIZE'], app.config['CHIPID_VERSION_CHECK_INTERVAL'])
+        self.dimensions = {}
+        self.numbers = {}
+        self.lock = Lock()
+        self.hits = self.shared_hits = self.misses = self.invalidations = 0
+
+    def _shared(self, method, *args):
+        try:
+            return getattr(self.shared, method)(*args)
+        except Exception as e:
+            self.app.logger.warning('Chip ID cache unavailable: %s', e)
+
+    def _version(self, value):
+        if not value:
+            return 0
+        version = self.versions.get(value)
+        if version is None:
+            version = db.session.execute(select([chipid_versions.c.version]).where(
+                chipid_versions.c.value == value)).scalar() or 0
+            self.versions.set(value, version)
+        return version
+
+    def page(self, key, compute):
+        """The cached page for ``key``, a ``(method, value, categories, page)`` tuple.
+
+        ``compute`` builds the page on a miss; it must return plain data.
+        """
+        key = key + (self._version(key[1]),)
+        page = self.local.get(key)
+        if page is not None:
+            self.hits += 1
+            return page
+        if self.shared is not None:
+            page = self._shared('get', json.dumps(key))
+            if page is not None:
+                self.shared_hits += 1
+                self.local.set(key, page)
+                return page
+        self.misses += 1
+        page = compute()
+        self.local.set(key, page)
+        if self.shared is not None:
+            self._shared('set', json.dumps(key), page)
+        return page
+
+    def invalidate(self, values):
+        """Forget the pages of these work order or approval numbers."""
+        values = set(values)
+        if not values:
+            return
+        self.invalidations += 1
+        # a connection of its own, the changed chips are committed by now
+        with db.engine.begin() as connection:
+            connection.execute(chipid_versions.update().where(chipid_versions.c.value.in_(values)).values(
+                version=chipid_versions.c.version + 1))
+            stamped = {row[0] for row in connection.execute(
+                select([chipid_versions.c.value]).where(chipid_versions.c.value.in_(values)))}
+            if values - stamped:
+                connection.execute(chipid_versions.insert(), [
+                    {'value': value, 'version': 1} for value in values - stamped])
+        self.versions.discard(lambda value: value in values)
+        self.local.discard(lambda key: key[1] in values)
+        forget_counts()
+
+    def dimension(self, model, column, ids=()):
+        """id -> value map of a dimension table, reloaded when one of ``ids`` is not in it."""
+        name = model.__tablename__
+        values = self.dimensions.get(name)
+        if values is None or not set(ids) <= values.keys():
+            table = model.__table__
+            values = dict(db.session.execute(select([table.c.id, table.c[column]])).fetchall())
+            with self.lock:
+                self.dimensions[name] = values
+        return values
+
+    def number_index(self, model, column):
+        """The NumberIndex of a dimension table, kept up to date with the table.
+
+        Other processes' changes are looked for at most every
+        CHIPID_NUMBER_CHECK_INTERVAL seconds, with one count(*) and max(id)
+        query. Rows added above the highest id seen are added to the index;
+        when that does not account for every new row, as when ids were
+        committed out of order or rows deleted, the index is rebuilt.
+        """
+        name = model.__tablename__
+        index = self.numbers.get(name)
+        if index is not None and time() - index.checked < self.app.config['CHIPID_NUMBER_CHECK_INTERVAL']:
+            return index
+        table = model.__table__
+        count, max_id = db.session.execute(select([func.count(), func.max(table.c.id)])).first()
+        max_id = max_id or 0
+        if index is None or (count, max_id) != (index.count, index.max_id):
+            added = None
+            if index is not None and max_id > index.max_id:
+                added = [row[0] for row in db.session.execute(select([table.c[column]]).where(
+                    table.c.id > index.max_id))]
+            if added is not None and index.count + len(added) == count:
+                index = index.extended([value for value in added if value is not None], max_id, count)
+            else:
+                values = [row[0] for row in db.session.execute(select([table.c[column]]).where(
+                    table.c[column].isnot(None)))]
+                index = NumberIndex(values, max_id, count)
+            with self.lock:
+                self.numbers[name] = index
+        index.checked = time()
+        return index
+
+    def forget_numbers(self, model):
+        with self.lock:
+            self.numbers.pop(model.__tablename__, None)
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        return {'hits': self.hits, 'shared_hits': self.shared_hits, 'misses': self.misses,
+                'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+                'invalidations': self.invalidations, 'size': len(self.local.entries),
+                'shared': self.shared is not None}
+
+
+class ChipCache(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['chip_cache'] = ResultCache(app)
+
+    @property
+    def cache(self):
+        return current_app.extensions['chip_cache']
+
+    def page(self, key, compute):
+        if not current_app.config['CHIPID_CACHE_TTL']:
+            return compute()
+        return self.cache.page(key, compute)
+
+    def invalidate(self, values):
+        self.cache.invalidate(values)
+
+    def dimension(self, model, column, ids=()):
+        return self.cache.dimension(model, column, ids)
+
+    def match(self, model, column, text, limit):
+        """Numbers of a dimension table that are, end with or start with ``text``; see NumberIndex.match."""
+        return self.cache.number_index(model, column).match(text, limit)
+
+    def forget_numbers(self, model):
+        self.cache.forget_numbers(model)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,224 @@
+import csv
+import io
+from collections import OrderedDict
+from time import time
+from sqlalchemy import bindparam, select
+from app import chip_cache, db
+from app.models import ApprovalNo, ChipId, ProductCategory, WorkOrderNo
+
+# accepted header names, in English or as shown on the query pages
+HEADERS = {
+    'chip_id': 'chip_id', '芯片ID': 'chip_id',
+    'asset_no': 'asset_no', '资产码': 'asset_no',
+    'work_order_no': 'work_order_no', '派工单号': 'work_order_no',
+    'approval_no': 'approval_no', '审批单号': 'approval_no',
+    'product_category': 'product_category', '产品型态': 'product_category',
+}
+# (dimension model, value column, foreign key on chip_id)
+DIMENSIONS = [
+    (WorkOrderNo, 'work_order_no', 'work_order_no_id'),
+    (ApprovalNo, 'approval_no', 'approval_no_id'),
+    (ProductCategory, 'product_category', 'product_category_id'),
+]
+IN_LIST_SIZE = 500
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _records(rows):
+    header = next(rows, None)
+    if header is None:
+        raise ImportFormatError('The file is empty.')
+    fields = [HEADERS.get(_cell(name)) for name in header]
+    missing = set(HEADERS.values()) - set(fields)
+    if missing:
+        raise ImportFormatError('Missing columns: {}'.format(', '.join(sorted(missing))))
+    for row in rows:
+        record = {field: _cell(value) for field, value in zip(fields, row) if field}
+        if any(record.values()):
+            yield record
+
+
+def read_csv(stream):
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    return _records(csv.reader(stream))
+
+
+def read_xlsx(stream):
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportFormatError('Reading Excel files needs openpyxl, upload a CSV file instead.')
+    workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    return _records(workbook.active.iter_rows(values_only=True))
+
+
+def read_rows(stream, filename):
+    """Stream chip records from a CSV or xlsx file, one dict per row."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        return read_xlsx(stream)
+    return read_csv(stream)
+
+
+def _chunks(values, size=IN_LIST_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class DimensionCache(object):
+    """value -> id map of one dimension table, resolved a batch at a time."""
+
+    def __init__(self, model, column):
+        self.model = model
+        self.table = model.__table__
+        self.column = self.table.c[column]
+        self.ids = {}
+        self.added = False
+
+    def _load(self, values):
+        for chunk in _chunks(values):
+            self.ids.update(db.session.execute(
+                select([self.column, self.table.c.id]).where(self.column.in_(chunk))).fetchall())
+
+    def resolve(self, values):
+        """Ids for ``values``, inserting the ones that do not exist yet."""
+        missing = set(values) - set(self.ids)
+        if missing:
+            self._load(missing)
+            new = missing - set(self.ids)
+            if new:
+                db.session.execute(self.table.insert(), [{self.column.name: value} for value in new])
+                self._load(new)
+                self.added = True
+        return self.ids
+
+
+class ChipImporter(object):
+    """Load chip records in batches with executemany inserts and updates.
+
+    A chip_id that already exists is updated in place, or reported when
+    ``update`` is False. An asset_no that belongs to a different chip is
+    always reported and the row skipped.
+    """
+
+    limits = {'chip_id': 48, 'asset_no': 22, 'work_order_no': 15, 'approval_no': 12, 'product_category': 20}
+
+    def __init__(self, batch_size=5000, update=True, max_reported=100):
+        self.batch_size = batch_size
+        self.update = update
+        self.max_reported = max_reported
+        self.dimensions = [(DimensionCache(model, column), column, key) for model, column, key in DIMENSIONS]
+        self.rows = self.inserted = self.updated = self.skipped = 0
+        self.elapsed = 0.0
+        self.problems = []
+
+    @property
+    def rate(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def report(self, line, message):
+        self.skipped += 1
+        if len(self.problems) < self.max_reported:
+            self.problems.append((line, message))
+
+    def run(self, records, progress=None):
+        start = time()
+        batch, chip_ids = [], set()
+        for line, record in enumerate(records, 2):
+            self.rows += 1
+            for field, limit in self.limits.items():
+                if not record.get(field):
+                    self.report(line, '{} is empty'.format(field))
+                    break
+                if len(record[field]) > limit:
+                    self.report(line, '{} is longer than {} characters'.format(field, limit))
+                    break
+            else:
+                record['work_order_no'] = record['work_order_no'].upper()
+                record['approval_no'] = record['approval_no'].upper()
+                if record['chip_id'] in chip_ids:
+                    # a repeated chip_id starts the next batch, so it is an update or reported as
+                    # existing just like one in a later batch
+                    self._load(batch)
+                    batch, chip_ids = [], set()
+                batch.append((line, record))
+                chip_ids.add(record['chip_id'])
+            if len(batch) >= self.batch_size:
+                self._load(batch)
+                batch, chip_ids = [], set()
+                self.elapsed = time() - start
+                if progress is not None:
+                    progress(self)
+        if batch:
+            self._load(batch)
+        self.elapsed = time() - start
+        return self
+
+    def _load(self, batch):
+        table = ChipId.__table__
+        records = OrderedDict((record['chip_id'], (line, record)) for line, record in batch)
+        ids = {}
+        for cache, column, key in self.dimensions:
+            ids[column] = cache.resolve({record[column] for line, record in records.values()})
+        existing, previous, owners = {}, {}, {}
+        for chunk in _chunks(records):
+            for chip_id, id, work_order_no_id, approval_no_id in db.session.execute(
+                    select([table.c.chip_id, table.c.id, table.c.work_order_no_id, table.c.approval_no_id]).where(
+                        table.c.chip_id.in_(chunk))):
+                existing[chip_id] = id
+                previous[chip_id] = (work_order_no_id, approval_no_id)
+        for chunk in _chunks({record['asset_no'] for line, record in records.values()}):
+            owners.update(db.session.execute(
+                select([table.c.asset_no, table.c.chip_id]).where(table.c.asset_no.in_(chunk))).fetchall())
+
+        inserts, updates, touched = [], [], set()
+        for chip_id, (line, record) in records.items():
+            owner = owners.get(record['asset_no'])
+            if owner is not None and owner != chip_id:
+                self.report(line, 'asset_no {} already belongs to chip {}'.format(record['asset_no'], owner))
+                continue
+            if chip_id in existing and not self.update:
+                self.report(line, 'chip_id {} already exists'.format(chip_id))
+                continue
+            owners[record['asset_no']] = chip_id
+            values = {'chip_id': chip_id, 'asset_no': record['asset_no']}
+            for cache, column, key in self.dimensions:
+                values[key] = ids[column][record[column]]
+            touched.update((record['work_order_no'], record['approval_no']))
+            if chip_id in existing:
+                updates.append({'_' + name: value for name, value in values.items()})
+            else:
+                inserts.append(values)
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        if updates:
+            db.session.execute(table.update().where(table.c.chip_id == bindparam('_chip_id')).values(
+                {name: bindparam('_' + name) for name in
+                 ('asset_no', 'work_order_no_id', 'approval_no_id', 'product_category_id')}), updates)
+        db.session.commit()
+        # only now can a rebuilt number index see the new numbers
+        for cache, column, key in self.dimensions:
+            if cache.added:
+                chip_cache.forget_numbers(cache.model)
+                cache.added = False
+        # cached query pages of the numbers the updated chips moved away from are stale too
+        moved = [previous[values['_chip_id']] for values in updates]
+        work_orders = chip_cache.dimension(WorkOrderNo, 'work_order_no', {ids[0] for ids in moved} - {None})
+        approvals = chip_cache.dimension(ApprovalNo, 'approval_no', {ids[1] for ids in moved} - {None})
+        touched.update(work_orders.get(ids[0]) for ids in moved)
+        touched.update(approvals.get(ids[1]) for ids in moved)
+        chip_cache.invalidate(touched - {None})
+        self.inserted += len(inserts)
+        self.updated += len(updates)
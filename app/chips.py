@@ -0,0 +1,161 @@
+import csv
+import io
+import json
+import re
+import tempfile
+from flask import request
+from app import chip_cache, db
+from app.chip_import import DIMENSIONS, HEADERS, IN_LIST_SIZE
+from app.models import ApprovalNo, ChipId, ProductCategory, WorkOrderNo
+from app.pagination import CachedPage, paginate
+
+FIELDS = ['chip_id', 'asset_no', 'work_order_no', 'approval_no', 'product_category']
+
+
+def chip_rows():
+    """Chips with their dimension values joined in, as plain rows in FIELDS order."""
+    return db.session.query(ChipId.chip_id, ChipId.asset_no, WorkOrderNo.work_order_no,
+                            ApprovalNo.approval_no, ProductCategory.product_category).select_from(
+        ChipId).outerjoin(ChipId.workorderno).outerjoin(ChipId.approvalno).outerjoin(ChipId.productcategory)
+
+
+def filter_results(query, method_query, field_query, product_category):
+    """The chipid_results filter: an approval (method 1) or work order number plus categories."""
+    if method_query == "1":
+        query = query.filter(ApprovalNo.approval_no == field_query)
+    else:
+        query = query.filter(WorkOrderNo.work_order_no == field_query)
+    return query.filter(ProductCategory.product_category.in_(product_category))
+
+
+def to_rows(chips):
+    """FIELDS dicts for ChipId objects, the dimension values taken from chip_cache."""
+    dimensions = []
+    for model, column, key in DIMENSIONS:
+        ids = {getattr(chip, key) for chip in chips} - {None}
+        dimensions.append((column, key, chip_cache.dimension(model, column, ids)))
+    rows = []
+    for chip in chips:
+        row = {'chip_id': chip.chip_id, 'asset_no': chip.asset_no}
+        for column, key, values in dimensions:
+            row[column] = values.get(getattr(chip, key))
+        rows.append(row)
+    return rows
+
+
+def resolve_number(method_query, field_query, limit):
+    """The approval (method 1) or work order numbers that ``field_query`` is, ends or starts.
+
+    Operators type the last digits of approval numbers, so a partial number
+    is completed from chip_cache's in-memory index instead of a LIKE scan.
+    """
+    if not field_query:
+        return []
+    if method_query == "1":
+        return chip_cache.match(ApprovalNo, 'approval_no', field_query, limit)
+    return chip_cache.match(WorkOrderNo, 'work_order_no', field_query, limit)
+
+
+def results_page(method_query, field_query, product_category):
+    """The chipid_results page of the request, served from chip_cache when it can be."""
+    page = request.args.get('cursor') or request.args.get('page', '1')
+    key = ('1' if method_query == '1' else '2', field_query, tuple(sorted(product_category)), page)
+
+    def compute():
+        if method_query == "1":
+            query = db.session.query(ChipId).join(ApprovalNo)
+        else:
+            query = db.session.query(ChipId).join(WorkOrderNo)
+        query = filter_results(query.join(ProductCategory), method_query, field_query, product_category)
+        pagination = paginate(query, [ChipId.id], descending=False, count=True)
+        return pagination.to_dict(to_rows(pagination.items))
+
+    return CachedPage(**chip_cache.page(key, compute))
+
+
+def export_rows(method_query, field_query, product_category, chunk_size=1000):
+    """All chipid_results rows, fetched ``chunk_size`` at a time from a server-side cursor."""
+    return filter_results(chip_rows(), method_query, field_query, product_category).order_by(
+        ChipId.id).execution_options(stream_results=True).yield_per(chunk_size)
+
+
+def parse_values(text):
+    """Split pasted or uploaded text into unique values, keeping their order."""
+    values = (value for value in re.split(r'[\s,;]+', text) if value and value not in HEADERS)
+    return list(dict.fromkeys(values))
+
+
+def lookup(values, by='chip_id', chunk_size=IN_LIST_SIZE):
+    """Yield ``(value, row)`` for every value, ``row`` being None when it did not match.
+
+    The values are looked up with one IN-list query per chunk.
+    """
+    column = getattr(ChipId, by)
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        found = {getattr(row, by): row for row in chip_rows().filter(column.in_(chunk))}
+        for value in chunk:
+            yield value, found.get(value)
+
+
+def csv_stream(header, rows, bom=False):
+    """Yield CSV text in chunks of about 64 KB."""
+    buffer = io.StringIO()
+    if bom:
+        buffer.write('\ufeff')  # lets Excel detect UTF-8
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def xlsx_file(header, rows):
+    """Write rows to a temporary xlsx file with openpyxl's write-only mode and return it."""
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in rows:
+        sheet.append(list(row))
+    f = tempfile.TemporaryFile()
+    workbook.save(f)
+    f.seek(0)
+    return f
+
+
+def stream_csv(results):
+    """CSV lines for ``(value, row)`` pairs; unmatched values follow the matches."""
+    unmatched = []
+
+    def rows():
+        for value, row in results:
+            if row is None:
+                unmatched.append(value)
+            else:
+                yield [value] + list(row)
+        for value in unmatched:
+            yield [value] + [''] * len(FIELDS)
+
+    return csv_stream(['query'] + FIELDS, rows())
+
+
+def stream_json(results, by):
+    parts = ['{{"by": {}, "matches": ['.format(json.dumps(by))]
+    unmatched = []
+    separator = ''
+    for value, row in results:
+        if row is None:
+            unmatched.append(value)
+            continue
+        parts.append(separator + json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False))
+        separator = ', '
+        if len(parts) >= 1000:
+            yield ''.join(parts)
+            parts = []
+    parts.append('], "unmatched": {}}}'.format(json.dumps(unmatched, ensure_ascii=False)))
+    yield ''.join(parts)
@@ -0,0 +1,204 @@
+from time import sleep, time
+import click
+from flask import Blueprint, current_app
+from app import jobs, passwords
+from app.assets import build, template_folders
+from app.chip_import import ChipImporter, ImportFormatError, read_rows
+from app.indexer import Reindexer
+from app.jobs import Worker
+from app.models import Post, User
+from app.recommendations import benchmark, rebuild
+from app.search import create_index
+from app.stream import benchmark as stream_benchmark
+
+bp = Blueprint('cli', __name__, cli_group=None)
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+
+@search.command()
+@click.option('--chunk-size', default=1000, show_default=True, help='Posts per bulk request.')
+@click.option('--workers', default=4, show_default=True, help='Threads sending bulk requests.')
+@click.option('--after', default=0, help='Resume after this post id (a reported checkpoint).')
+@click.option('--swap', is_flag=True, help='Build a new index and swap it in under the alias.')
+@click.option('--into', help='Build into this existing index and swap it in, to resume a --swap run.')
+def reindex(chunk_size, workers, after, swap, into):
+    """Rebuild the post search index."""
+    if not current_app.search_backend:
+        raise click.ClickException('Search is switched off (SEARCH_BACKEND=none).')
+    reindexer = Reindexer(Post, chunk_size, workers, after)
+    reported = [0]
+
+    def progress(checkpoint, count, elapsed):
+        if time() - reported[0] >= 1:
+            reported[0] = time()
+            click.echo('{} posts, {:.0f} posts/s, checkpoint {}'.format(
+                count, count / max(elapsed, 1e-6), checkpoint))
+
+    start = time()
+    try:
+        if swap or into:
+            if not into:
+                into = '{}-{}'.format(Post.__tablename__, int(start))
+                create_index(into)
+            click.echo('Building {}'.format(into))
+            reindexer.rebuild(into, progress)
+        else:
+            reindexer.run(progress=progress)
+    except Exception as e:
+        resume = '--after {}'.format(reindexer.checkpoint)
+        if into:
+            resume += ' --into {}'.format(into)
+        raise click.ClickException('{}; resume with {}'.format(e, resume))
+    elapsed = time() - start
+    click.echo('Indexed {} posts in {:.1f}s ({:.0f} posts/s)'.format(
+        reindexer.count, elapsed, reindexer.count / max(elapsed, 1e-6)))
+
+
+@bp.cli.command()
+@click.option('--threads', type=int, help='Worker threads.  [default: JOBS_WORKERS]')
+def worker(threads):
+    """Run queued jobs until interrupted.
+
+    Set JOBS_IN_APP=false for the web processes to leave all jobs to this one.
+    """
+    worker = Worker(current_app._get_current_object(), jobs.handlers, threads)
+    worker.start()
+    click.echo('Running jobs with {} threads'.format(worker.size))
+    try:
+        while True:
+            sleep(60)
+            current_app.logger.info('Jobs: %s', dict(worker.metrics))
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+@bp.cli.group('jobs')
+def jobs_group():
+    """Job queue commands."""
+    pass
+
+
+@jobs_group.command()
+def status():
+    """Show queued and failed jobs by kind."""
+    for kind, states in sorted(jobs.stats()['queue'].items()):
+        click.echo('{}: {}'.format(kind, ', '.join('{} {}'.format(count, state)
+                                                   for state, count in sorted(states.items()))))
+
+
+@bp.cli.group()
+def users():
+    """User commands."""
+    pass
+
+
+@users.command()
+def recount():
+    """Repair drifted follower, following and post counters."""
+    click.echo('Repaired the counters of {} users'.format(User.reconcile_counts()))
+
+
+@users.command('dedupe-follows')
+def dedupe_follows():
+    """Remove follows stored more than once, before the followers unique constraint is added."""
+    click.echo('Removed {} duplicate follows'.format(User.remove_duplicate_follows()))
+
+
+@users.command('benchmark-logins')
+@click.option('--seconds', default=5.0, show_default=True)
+@click.option('--clients', type=int, help='Concurrent sign-ins.  [default: twice the hash workers]')
+def benchmark_logins(seconds, clients):
+    """Measure password checks per second through the hashing pool."""
+    result = passwords.benchmark(seconds, clients)
+    click.echo('{logins_per_second:.1f} logins/s on {cores} cores ({logins_per_second_per_core:.1f} per core), '
+               '{rejected} rejected as busy with {method}'.format(
+                   method=current_app.config['PASSWORD_HASH_METHOD'], **result))
+
+
+@users.command()
+@click.option('--top-k', type=int, help='Suggestions kept per user.  [default: RECOMMENDATIONS_TOP_K]')
+def recommend(top_k):
+    """Recompute who-to-follow suggestions for every user."""
+    start = time()
+    rows = rebuild(top_k or current_app.config['RECOMMENDATIONS_TOP_K'],
+                   current_app.config['RECOMMENDATIONS_MAX_FANOUT'])
+    click.echo('Stored {} suggestions in {:.1f}s'.format(rows, time() - start))
+
+
+@users.command('benchmark-recommendations')
+@click.option('--users', 'count', default=100000, show_default=True, help='Users in the synthetic graph.')
+@click.option('--follows', default=20, show_default=True, help='Average accounts each user follows.')
+@click.option('--seed', default=0, show_default=True)
+def benchmark_recommendations(count, follows, seed):
+    """Time the recommendation batch on a synthetic follower graph."""
+    result = benchmark(count, follows, current_app.config['RECOMMENDATIONS_TOP_K'],
+                       current_app.config['RECOMMENDATIONS_MAX_FANOUT'], seed)
+    click.echo('{users} users, {edges} edges: loaded in {load_seconds:.1f}s, computed {rows} suggestions '
+               'in {compute_seconds:.1f}s ({edges_per_second:.0f} edges/s), peak RSS {peak_rss_mb:.0f} MB'.format(
+                   **result))
+
+
+@bp.cli.group()
+def stream():
+    """Live timeline stream commands."""
+    pass
+
+
+@stream.command('benchmark')
+@click.option('--connections', default=1000, show_default=True, help='Idle connections to open.')
+def benchmark_stream(connections):
+    """Measure the memory held by idle timeline stream connections."""
+    result = stream_benchmark(connections)
+    click.echo('{connections} idle connections hold {rss_mb:.1f} MB ({connections_per_mb:.0f} per MB); '
+               'one post per author reached them in {publish_seconds:.3f}s'.format(**result))
+
+
+@bp.cli.group()
+def chipid():
+    """Chip ID commands."""
+    pass
+
+
+@chipid.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, help='Rows per insert batch.  [default: CHIPID_IMPORT_BATCH_SIZE]')
+@click.option('--skip-existing', is_flag=True, help='Report chip IDs that already exist instead of updating them.')
+def import_chipids(path, batch_size, skip_existing):
+    """Import chip ID / asset number pairs from a CSV or xlsx file."""
+    importer = ChipImporter(batch_size or current_app.config['CHIPID_IMPORT_BATCH_SIZE'], not skip_existing)
+
+    def progress(importer):
+        click.echo('{} rows, {:.0f} rows/s'.format(importer.rows, importer.rate))
+
+    with open(path, 'rb') as f:
+        try:
+            importer.run(read_rows(f, path), progress)
+        except ImportFormatError as e:
+            raise click.ClickException(str(e))
+    for line, message in importer.problems:
+        click.echo('line {}: {}'.format(line, message), err=True)
+    click.echo('Read {} rows in {:.1f}s ({:.0f} rows/s): {} inserted, {} updated, {} skipped'.format(
+        importer.rows, importer.elapsed, importer.rate, importer.inserted, importer.updated, importer.skipped))
+
+
+@bp.cli.group()
+def assets():
+    """Static asset commands."""
+    pass
+
+
+@assets.command('build')
+def build_assets():
+    """Fingerprint and precompress the static files the templates use."""
+    app = current_app._get_current_object()
+    output = app.config['ASSETS_BUILD_DIR']
+    manifest = build(app.static_folder, template_folders(app), output,
+                     include=app.config['ASSETS_INCLUDE'], min_size=app.config['ASSETS_COMPRESS_MIN_SIZE'])
+    stored = set(manifest['files'].values())
+    click.echo('Built {} files ({} names, {} precompressed) into {}; restart the app to serve them'.format(
+        len(stored), len(manifest['files']), len(manifest['encodings']), output))
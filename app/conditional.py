@@ -0,0 +1,29 @@
+from hashlib import md5
+from flask import Response, make_response, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+
+def conditional(validator, render, last_modified=None):
+    """Answer a GET with 304 when ``validator`` still matches the client's copy.
+
+    ``validator`` is a tuple of cheap values that change whenever the page
+    would; the viewer, whose username every page shows, and the query string
+    are added to it. ``render`` is
+    only called when the page has to be sent. Pass ``last_modified`` only
+    when the page changes with nothing but that time.
+    """
+    if request.method != 'GET' or '_flashes' in session:
+        return render()
+    viewer = (current_user.get_id(), getattr(current_user, 'username', None))
+    etag = md5(repr(validator + viewer + (request.full_path,)).encode('utf-8')).hexdigest()
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
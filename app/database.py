@@ -0,0 +1,121 @@
+import random
+from functools import wraps
+from time import time
+from flask import g, has_app_context, has_request_context, session as cookie
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import SelectBase
+
+
+def replica_reads(f):
+    """Let the SELECTs of a view go to a replica.
+
+    Only plain SELECTs move, and only while the request has written nothing
+    and the user has not written in the last SQLALCHEMY_REPLICA_LAG seconds.
+    Everything else stays on the primary.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.replica_reads = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.replica_reads = False
+    return decorated
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends the reads of ``replica_reads`` views to a replica."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or (clause is not None and not isinstance(clause, SelectBase)):
+            self.info['wrote'] = True
+        elif isinstance(clause, SelectBase) and not self.info.get('wrote') and has_app_context() and \
+                g.get('replica_reads') and not self._recently_wrote():
+            replica = self._replica()
+            if replica is not None:
+                return replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    @staticmethod
+    def _recently_wrote():
+        return has_request_context() and cookie.get('db_primary_until', 0) > time()
+
+    def _replica(self):
+        replicas = self.app.extensions['db_replicas']
+        if not replicas:
+            return None
+        # one replica for the whole session, so its reads see one snapshot
+        if 'replica' not in self.info:
+            self.info['replica'] = random.choice(replicas)
+        return self.app.extensions['sqlalchemy'].db.get_engine(self.app, bind=self.info['replica'])
+
+
+def _after_commit(session):
+    # the writer reads from the primary until the replicas have caught up
+    if session.info.pop('wrote', False) and session.app.extensions['db_replicas'] and has_request_context():
+        lag = session.app.config['SQLALCHEMY_REPLICA_LAG']
+        if lag:
+            cookie['db_primary_until'] = time() + lag
+
+
+def _after_rollback(session):
+    session.info.pop('wrote', None)
+
+
+def _sqlite_pragmas(memory, busy_timeout):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not memory:
+            # readers no longer block the writer, and commits skip most fsyncs
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(busy_timeout))
+        cursor.close()
+    return connect
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with read replicas, tuned pools and SQLite pragmas.
+
+    Each URI in SQLALCHEMY_REPLICA_URIS becomes a ``replicaN`` bind that
+    ``replica_reads`` views read from. Server databases get a pool of
+    DATABASE_POOL_SIZE connections that are pinged before use and recycled
+    after DATABASE_POOL_RECYCLE seconds; SQLite files are switched to WAL.
+    SQLALCHEMY_ENGINE_OPTIONS still overrides all of it.
+    """
+
+    def init_app(self, app):
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        replicas = []
+        for i, uri in enumerate(app.config['SQLALCHEMY_REPLICA_URIS']):
+            replicas.append('replica{}'.format(i))
+            binds[replicas[-1]] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        app.extensions['db_replicas'] = replicas
+        super(RoutingSQLAlchemy, self).init_app(app)
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_commit', _after_commit)
+        event.listen(factory, 'after_rollback', _after_rollback)
+        return factory
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(RoutingSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            options['sqlite_pragmas'] = _sqlite_pragmas(sa_url.database in (None, '', ':memory:'),
+                                                        app.config['SQLITE_BUSY_TIMEOUT'])
+            return
+        options['pool_size'] = app.config['DATABASE_POOL_SIZE']
+        options['max_overflow'] = app.config['DATABASE_MAX_OVERFLOW']
+        options['pool_timeout'] = app.config['DATABASE_POOL_TIMEOUT']
+        options['pool_recycle'] = app.config['DATABASE_POOL_RECYCLE']
+        options['pool_pre_ping'] = app.config['DATABASE_POOL_PRE_PING']
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = super(RoutingSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if pragmas is not None:
+            event.listen(engine, 'connect', pragmas)
+        return engine
@@ -8,6 +8,11 @@ def not_found_error(error):
     return render_template('errors/404.html'), 404
 
 
+@bp.app_errorhandler(503)
+def unavailable_error(error):
+    return render_template('errors/503.html', error=error), 503, {'Retry-After': '5'}
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
@@ -0,0 +1,71 @@
+from flask import current_app, render_template
+from markupsafe import Markup
+from app.cache import LRUCache
+
+
+class PageCache(object):
+    """Rendered HTML kept in memory: single posts and the post list of /explore.
+
+    A post is rendered from ``_post.html`` once per ``(id, author username,
+    avatar hash)`` and reused by every page that lists it. The /explore list
+    is the same for every viewer, so it is kept for EXPLORE_CACHE_TTL seconds
+    under the newest post and author change, and dropped when a post is added
+    or deleted in this process. The page around it, with the viewer's
+    navigation, is still rendered per request.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['page_cache'] = {
+            'posts': LRUCache(app.config['POST_FRAGMENT_CACHE_SIZE'], app.config['POST_FRAGMENT_CACHE_TTL']),
+            'explore': LRUCache(app.config['EXPLORE_CACHE_SIZE'], app.config['EXPLORE_CACHE_TTL']),
+        }
+        app.add_template_global(self.render_post)
+
+    @property
+    def caches(self):
+        return current_app.extensions['page_cache']
+
+    def render_post(self, post):
+        from app.models import avatar_hash
+        author = post.author
+        key = (post.id, author.username, avatar_hash(author.email))
+        cache = self.caches['posts']
+        html = cache.get(key)
+        if html is None:
+            html = Markup(render_template('_post.html', post=post))
+            cache.set(key, html)
+        return html
+
+    def explore(self, key, render):
+        """The cached /explore list for ``key``, rendered by ``render`` on a miss."""
+        if not current_app.config['EXPLORE_CACHE_TTL']:
+            return render()
+        cache = self.caches['explore']
+        html = cache.get(key)
+        if html is None:
+            html = Markup(render())
+            cache.set(key, html)
+        return html
+
+    def stats(self):
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        from app.models import Post
+        if any(isinstance(obj, Post) for obj in session.new) or \
+                any(isinstance(obj, Post) for obj in session.deleted):
+            session.info['explore_changed'] = True
+
+    @staticmethod
+    def after_commit(session):
+        if session.info.pop('explore_changed', False) and 'page_cache' in current_app.extensions:
+            current_app.extensions['page_cache']['explore'].clear()
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('explore_changed', None)
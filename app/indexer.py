@@ -0,0 +1,343 @@
+import atexit
+import json
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Event, Thread
+from time import sleep, time
+from flask import current_app, has_app_context
+from app import db
+from app.search import bulk_index, point_alias
+
+# Changes that could not be sent to the search cluster. They are written here
+# once the retries are used up and replayed when the cluster is back.
+search_backlog = db.Table('search_backlog',
+                          db.Column('id', db.Integer, primary_key=True),
+                          db.Column('index', db.String(64), nullable=False),
+                          db.Column('doc_id', db.Integer, nullable=False),
+                          db.Column('payload', db.Text),
+                          db.UniqueConstraint('index', 'doc_id')
+                          )
+
+# Indexes being rebuilt by Reindexer.rebuild, and the documents changed under
+# their alias meanwhile. The rebuild sends the current rows of those documents
+# to the new index, so changes made to rows it has already copied are kept.
+search_rebuilds = db.Table('search_rebuilds',
+                           db.Column('index', db.String(64), primary_key=True),
+                           db.Column('alias', db.String(64), nullable=False)
+                           )
+search_changes = db.Table('search_changes',
+                          db.Column('id', db.Integer, primary_key=True),
+                          db.Column('index', db.String(64), nullable=False),
+                          db.Column('doc_id', db.Integer, nullable=False)
+                          )
+
+
+class IndexQueue(object):
+    """Pending search index changes of one application.
+
+    Changes are keyed on ``(index, id)`` so repeated updates to the same
+    document collapse into one. A background thread sends them in bulk,
+    retrying with exponential backoff and parking them in ``search_backlog``
+    when the cluster stays unreachable.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = OrderedDict()
+        self.cond = Condition()
+        self.stopped = Event()
+        self.thread = None
+        self.has_backlog = True
+        self.rebuilding = frozenset()
+        self.rebuilding_checked = 0
+
+    def put(self, index, changes):
+        if index in self._rebuilding():
+            with db.engine.begin() as connection:
+                connection.execute(search_changes.insert(), [{'index': index, 'doc_id': id} for id in changes])
+        with self.cond:
+            for id, payload in changes.items():
+                self.pending.pop((index, id), None)
+                self.pending[(index, id)] = payload
+            if len(self.pending) >= self.app.config['SEARCH_INDEX_BATCH_SIZE']:
+                self.cond.notify()
+        if not self.app.config['SEARCH_INDEX_ASYNC']:
+            # no backoff sleeps inside the request; what fails goes to the backlog
+            self.flush(retry=False)
+        elif self.thread is None:
+            self.start()
+
+    def _rebuilding(self):
+        """Aliases whose index is being rebuilt, looked up at most every SEARCH_REBUILD_CHECK_INTERVAL."""
+        now = time()
+        if now - self.rebuilding_checked >= self.app.config['SEARCH_REBUILD_CHECK_INTERVAL']:
+            with db.engine.connect() as connection:
+                self.rebuilding = frozenset(row[0] for row in connection.execute(
+                    db.select([search_rebuilds.c.alias])))
+            self.rebuilding_checked = now
+        return self.rebuilding
+
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name='search-indexer', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        if self.thread is None and not self.pending:
+            return
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush(retry=False)
+
+    def _take(self):
+        with self.cond:
+            batch = []
+            while self.pending and len(batch) < self.app.config['SEARCH_INDEX_BATCH_SIZE']:
+                batch.append(self.pending.popitem(last=False))
+            return batch
+
+    def _run(self):
+        with self.app.app_context():
+            while not self.stopped.is_set():
+                with self.cond:
+                    if not self.pending:
+                        self.cond.wait(self.app.config['SEARCH_INDEX_FLUSH_INTERVAL'])
+                self.flush()
+
+    def flush(self, retry=True):
+        """Send everything that is pending, then replay the backlog."""
+        if not has_app_context():
+            with self.app.app_context():
+                return self.flush(retry)
+        batch = self._take()
+        while batch:
+            self._send(batch, retry)
+            batch = self._take()
+        if self.has_backlog:
+            self._replay()
+
+    def _send(self, batch, retry=True):
+        retries = self.app.config['SEARCH_INDEX_MAX_RETRIES'] if retry else 0
+        delay = self.app.config['SEARCH_INDEX_RETRY_BACKOFF']
+        delivered = []
+        for attempt in range(retries + 1):
+            if attempt:
+                if self.stopped.wait(delay):
+                    break
+                delay *= 2
+            try:
+                failed = bulk_index(batch)
+            except Exception as e:
+                self.app.logger.warning('Search indexing failed: %s', e)
+                failed = [key for key, payload in batch]
+            failed = set(failed)
+            delivered.extend(key for key, payload in batch if key not in failed)
+            batch = [(key, payload) for key, payload in batch if key in failed]
+            if not batch:
+                break
+        self._forget(delivered)
+        if not batch:
+            return True
+        self._park(batch)
+        return False
+
+    def _forget(self, keys):
+        """Drop the parked changes ``keys`` superseded, so replaying them does not undo newer ones."""
+        if not self.has_backlog or not keys:
+            return
+        by_index = {}
+        for index, id in keys:
+            by_index.setdefault(index, []).append(id)
+        with db.engine.begin() as connection:
+            for index, ids in by_index.items():
+                connection.execute(search_backlog.delete().where(
+                    search_backlog.c.index == index).where(search_backlog.c.doc_id.in_(ids)))
+
+    def _park(self, batch):
+        # a connection of its own, this may run inside another session's commit
+        with db.engine.begin() as connection:
+            for (index, id), payload in batch:
+                connection.execute(search_backlog.delete().where(
+                    search_backlog.c.index == index).where(search_backlog.c.doc_id == id))
+                connection.execute(search_backlog.insert().values(
+                    index=index, doc_id=id, payload=None if payload is None else json.dumps(payload)))
+        self.has_backlog = True
+
+    def _replay(self):
+        with db.engine.connect() as connection:
+            rows = connection.execute(search_backlog.select().order_by(search_backlog.c.id).limit(
+                self.app.config['SEARCH_INDEX_BATCH_SIZE'])).fetchall()
+        if not rows:
+            self.has_backlog = False
+            return
+        batch = [((row.index, row.doc_id), None if row.payload is None else json.loads(row.payload))
+                 for row in rows]
+        try:
+            failed = set(bulk_index(batch))
+        except Exception as e:
+            self.app.logger.warning('Search backlog replay failed: %s', e)
+            return
+        done = [row.id for row, (key, payload) in zip(rows, batch) if key not in failed]
+        if done:
+            with db.engine.begin() as connection:
+                connection.execute(search_backlog.delete().where(search_backlog.c.id.in_(done)))
+        if len(rows) < self.app.config['SEARCH_INDEX_BATCH_SIZE'] and len(done) == len(rows):
+            self.has_backlog = False
+
+
+class SearchIndexer(object):
+    def __init__(self, app=None):
+        self.queues = weakref.WeakSet()
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        queue = IndexQueue(app)
+        self.queues.add(queue)
+        app.extensions['search_indexer'] = queue
+
+    @property
+    def queue(self):
+        return current_app.extensions['search_indexer']
+
+    def put(self, index, changes):
+        """Queue ``{id: payload}`` changes; a payload of None removes the document."""
+        if not current_app.search_backend or not changes:
+            return
+        self.queue.put(index, changes)
+
+    def flush(self):
+        self.queue.flush()
+
+    def shutdown(self):
+        for queue in list(self.queues):
+            queue.stop()
+
+
+class Reindexer(object):
+    """Rebuild the search index of a model straight from its table.
+
+    Rows are streamed in id order as plain column tuples, so the identity map
+    stays empty, and sent in bulk chunks by a pool of ``workers`` threads.
+    ``checkpoint`` is the highest id below which every row has been indexed;
+    pass it back as ``after`` to resume an interrupted run.
+    """
+
+    def __init__(self, model, chunk_size=1000, workers=1, after=0):
+        self.model = model
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.checkpoint = after
+        self.count = 0
+
+    def _chunks(self):
+        fields = self.model.__searchable__
+        query = db.session.query(self.model.id, *[getattr(self.model, field) for field in fields]).filter(
+            self.model.id > self.checkpoint).order_by(self.model.id).yield_per(self.chunk_size)
+        chunk = []
+        for row in query:
+            chunk.append((row[0], dict(zip(fields, row[1:]))))
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _send(app, index, chunk):
+        with app.app_context():
+            changes = [((index, id), payload) for id, payload in chunk]
+            delay = app.config['SEARCH_INDEX_RETRY_BACKOFF']
+            for attempt in range(app.config['SEARCH_INDEX_MAX_RETRIES'] + 1):
+                if attempt:
+                    sleep(delay)
+                    delay *= 2
+                try:
+                    failed = set(bulk_index(changes))
+                except Exception as e:
+                    app.logger.warning('Search indexing failed: %s', e)
+                    failed = {key for key, payload in changes}
+                if not failed:
+                    return
+                changes = [(key, payload) for key, payload in changes if key in failed]
+            raise RuntimeError('{} documents could not be indexed'.format(len(changes)))
+
+    def run(self, index=None, progress=None):
+        """Index every row after the checkpoint into ``index``.
+
+        ``progress`` is called with ``(checkpoint, count, elapsed)`` each time
+        the checkpoint moves.
+        """
+        app = current_app._get_current_object()
+        index = index or self.model.__tablename__
+        start = time()
+        in_flight = deque()
+
+        def complete():
+            last_id, size, future = in_flight.popleft()
+            future.result()
+            self.checkpoint = last_id
+            self.count += size
+            if progress is not None:
+                progress(self.checkpoint, self.count, time() - start)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for chunk in self._chunks():
+                in_flight.append((chunk[-1][0], len(chunk), executor.submit(self._send, app, index, chunk)))
+                while in_flight and (in_flight[0][2].done() or len(in_flight) > 2 * self.workers):
+                    complete()
+            while in_flight:
+                complete()
+        return self.count
+
+    def replay(self, index):
+        """Send the current rows of the documents logged in ``search_changes`` to ``index``."""
+        app = current_app._get_current_object()
+        alias = self.model.__tablename__
+        fields = self.model.__searchable__
+        table = self.model.__table__
+        while True:
+            with db.engine.connect() as connection:
+                logged = connection.execute(search_changes.select().where(
+                    search_changes.c.index == alias).order_by(search_changes.c.id).limit(
+                    self.chunk_size)).fetchall()
+                if not logged:
+                    return
+                ids = sorted({row.doc_id for row in logged})
+                rows = connection.execute(db.select([table.c.id] + [table.c[field] for field in fields]).where(
+                    table.c.id.in_(ids)))
+                current = {row[0]: dict(zip(fields, row[1:])) for row in rows}
+            # rows that are gone are removed from the index
+            self._send(app, index, [(id, current.get(id)) for id in ids])
+            with db.engine.begin() as connection:
+                connection.execute(search_changes.delete().where(search_changes.c.index == alias).where(
+                    search_changes.c.id <= logged[-1].id))
+
+    def rebuild(self, into, progress=None):
+        """Build the index ``into`` and swap it in under the model's alias.
+
+        While it runs every process logs the documents it changes, and their
+        current rows are sent to ``into`` before the swap, then once more
+        for what was logged until the swap. An interrupted rebuild stays
+        registered, so a resumed one still sees the changes made meanwhile.
+        """
+        alias = self.model.__tablename__
+        with db.engine.begin() as connection:
+            connection.execute(search_rebuilds.delete().where(search_rebuilds.c.index == into))
+            connection.execute(search_rebuilds.insert().values(index=into, alias=alias))
+        # processes that have not noticed the rebuild yet commit before the copy reads their rows
+        sleep(current_app.config['SEARCH_REBUILD_CHECK_INTERVAL'])
+        self.run(into, progress)
+        self.replay(into)
+        point_alias(alias, into)
+        with db.engine.begin() as connection:
+            connection.execute(search_rebuilds.delete().where(search_rebuilds.c.index == into))
+        self.replay(alias)
+        return self.count
@@ -0,0 +1,221 @@
+import atexit
+import json
+import uuid
+import weakref
+from collections import defaultdict
+from datetime import datetime, timedelta
+from threading import Condition, Event, Lock, Thread
+from time import time
+from flask import current_app, has_app_context
+from sqlalchemy import func, select
+from app import db
+
+# Deferred work that must not be lost: a row is written in the same
+# transaction as the change that asked for it and deleted once a worker has
+# run it. Rows that keep failing stay behind with state 'failed'.
+job = db.Table('job',
+               db.Column('id', db.Integer, primary_key=True),
+               db.Column('kind', db.String(64), nullable=False),
+               db.Column('payload', db.Text, nullable=False),
+               db.Column('state', db.String(16), nullable=False, default='pending'),
+               db.Column('attempts', db.Integer, nullable=False, default=0),
+               db.Column('run_at', db.DateTime, nullable=False),
+               db.Column('owner', db.String(36)),
+               db.Column('claimed_at', db.DateTime),
+               db.Column('last_error', db.Text),
+               db.Index('ix_job_state_run_at', 'state', 'run_at')
+               )
+
+
+class PermanentError(Exception):
+    """Returned or raised by a handler for a job that should not be retried."""
+
+
+class Worker(object):
+    """The job workers of one application.
+
+    ``threads`` threads claim batches of due jobs, run them through the
+    handler of their kind and retry failures with exponential backoff. With
+    JOBS_ASYNC off, jobs run right after the commit that queued them.
+    """
+
+    def __init__(self, app, handlers, threads=None):
+        self.app = app
+        self.handlers = handlers
+        self.size = threads or app.config['JOBS_WORKERS']
+        self.threads = []
+        self.cond = Condition()
+        self.stopped = Event()
+        self.lock = Lock()
+        self.metrics = defaultdict(int)
+
+    def start(self):
+        with self.cond:
+            if self.threads:
+                return
+            self.stopped.clear()
+            for i in range(self.size):
+                thread = Thread(target=self._run, name='job-worker-{}'.format(i), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        self.notify()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def _run(self):
+        with self.app.app_context():
+            while not self.stopped.is_set():
+                try:
+                    done = self.work_once()
+                except Exception:
+                    self.app.logger.exception('Job worker failed')
+                    done = 0
+                if not done:
+                    with self.cond:
+                        self.cond.wait(self.app.config['JOBS_POLL_INTERVAL'])
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.metrics[name] += value
+
+    def claim(self):
+        """Take a batch of due jobs for this worker; returns their rows."""
+        config = self.app.config
+        now = datetime.utcnow()
+        owner = str(uuid.uuid4())
+        with db.engine.begin() as connection:
+            # jobs of a worker that died mid-batch become due again
+            connection.execute(job.update().where(job.c.state == 'running').where(
+                job.c.claimed_at < now - timedelta(seconds=config['JOBS_CLAIM_TIMEOUT'])).values(
+                state='pending', owner=None))
+            ids = [row[0] for row in connection.execute(
+                select([job.c.id]).where(job.c.state == 'pending').where(job.c.run_at <= now).order_by(
+                    job.c.id).limit(config['JOBS_BATCH_SIZE']))]
+            if not ids:
+                return []
+            connection.execute(job.update().where(job.c.id.in_(ids)).where(job.c.state == 'pending').values(
+                state='running', owner=owner, claimed_at=now))
+        with db.engine.connect() as connection:
+            return connection.execute(job.select().where(job.c.owner == owner).order_by(job.c.id)).fetchall()
+
+    def work_once(self):
+        """Claim and run one batch; returns the number of jobs it held."""
+        if not has_app_context():
+            with self.app.app_context():
+                return self.work_once()
+        rows = self.claim()
+        by_kind = defaultdict(list)
+        for row in rows:
+            by_kind[row.kind].append(row)
+        for kind, batch in by_kind.items():
+            self._run_batch(kind, batch)
+        return len(rows)
+
+    def _run_batch(self, kind, batch):
+        start = time()
+        handler = self.handlers.get(kind)
+        try:
+            if handler is None:
+                raise PermanentError('No handler for {} jobs'.format(kind))
+            results = list(handler([json.loads(row.payload) for row in batch]))
+        except Exception as e:
+            results = [e] * len(batch)
+        self._count('batches')
+        self._count('seconds', time() - start)
+        done, retry, failed = [], [], []
+        for row, result in zip(batch, results):
+            if result is None:
+                done.append(row.id)
+            elif isinstance(result, PermanentError) or row.attempts + 1 >= self.app.config['JOBS_MAX_ATTEMPTS']:
+                failed.append((row, result))
+            else:
+                retry.append((row, result))
+        now = datetime.utcnow()
+        with db.engine.begin() as connection:
+            if done:
+                connection.execute(job.delete().where(job.c.id.in_(done)))
+            for row, error in retry:
+                delay = self.app.config['JOBS_RETRY_BACKOFF'] * 2 ** row.attempts
+                connection.execute(job.update().where(job.c.id == row.id).values(
+                    state='pending', owner=None, attempts=row.attempts + 1, last_error=str(error),
+                    run_at=now + timedelta(seconds=delay)))
+            for row, error in failed:
+                connection.execute(job.update().where(job.c.id == row.id).values(
+                    state='failed', owner=None, attempts=row.attempts + 1, last_error=str(error)))
+        for row, error in retry + failed:
+            self.app.logger.warning('%s job %s failed (attempt %s): %s', kind, row.id, row.attempts + 1, error)
+        self._count(kind + '.done', len(done))
+        self._count(kind + '.retried', len(retry))
+        self._count(kind + '.failed', len(failed))
+
+
+class JobQueue(object):
+    def __init__(self, app=None):
+        self.handlers = {}
+        self.workers = weakref.WeakSet()
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        worker = Worker(app, self.handlers)
+        self.workers.add(worker)
+        app.extensions['jobs'] = worker
+
+    @property
+    def worker(self):
+        return current_app.extensions['jobs']
+
+    def handler(self, kind):
+        """Register ``f(payloads)`` to run jobs of ``kind`` a batch at a time.
+
+        It returns one result per payload: None when the job is done, or the
+        exception it failed with.
+        """
+        def decorator(f):
+            self.handlers[kind] = f
+            return f
+        return decorator
+
+    def enqueue(self, kind, payload, delay=0):
+        """Queue a job in the current transaction; it runs once that is committed."""
+        db.session.execute(job.insert().values(
+            kind=kind, payload=json.dumps(payload), state='pending', attempts=0,
+            run_at=datetime.utcnow() + timedelta(seconds=delay)))
+        db.session.info['jobs_queued'] = True
+
+    def stats(self):
+        """Jobs in the table by kind and state, and this process' counters."""
+        depth = defaultdict(dict)
+        for kind, state, count in db.session.query(job.c.kind, job.c.state, func.count()).group_by(
+                job.c.kind, job.c.state):
+            depth[kind][state] = count
+        return {'queue': dict(depth), 'worker': dict(self.worker.metrics)}
+
+    def after_commit(self, session):
+        if not session.info.pop('jobs_queued', False) or 'jobs' not in current_app.extensions:
+            return
+        worker = self.worker
+        if not current_app.config['JOBS_ASYNC']:
+            while worker.work_once():
+                pass
+        elif current_app.config['JOBS_IN_APP']:
+            worker.start()
+            worker.notify()
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('jobs_queued', None)
+
+    def shutdown(self):
+        for worker in list(self.workers):
+            if worker.threads:
+                worker.stop()
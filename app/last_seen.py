@@ -0,0 +1,69 @@
+import atexit
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+from flask import current_app, has_app_context
+from sqlalchemy import bindparam
+
+
+class LastSeenTracker(object):
+    """Write-behind store for ``User.last_seen``.
+
+    Page views only record the time in memory. The pending timestamps are
+    written in one batched UPDATE once LAST_SEEN_FLUSH_COUNT users are
+    waiting, LAST_SEEN_FLUSH_INTERVAL seconds have passed, or the process
+    exits. Users whose stored value is newer than LAST_SEEN_THRESHOLD seconds
+    are not recorded at all.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.pending = {}
+        self.lock = Lock()
+        self.last_flush = time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.flush)
+        self.app = app
+        app.extensions['last_seen'] = self
+
+    def touch(self, user, now=None):
+        now = now or datetime.utcnow()
+        config = current_app.config
+        if user.last_seen is not None and \
+                now - user.last_seen < timedelta(seconds=config['LAST_SEEN_THRESHOLD']):
+            return
+        with self.lock:
+            self.pending[user.id] = now
+            due = len(self.pending) >= config['LAST_SEEN_FLUSH_COUNT'] or \
+                time() - self.last_flush >= config['LAST_SEEN_FLUSH_INTERVAL']
+        if due:
+            self.flush()
+
+    def flush(self):
+        from app import db
+        from app.models import User
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time()
+        if not pending:
+            return
+        app = current_app._get_current_object() if has_app_context() else self.app
+        table = User.__table__
+        update = table.update().where(table.c.id == bindparam('_id')).values(
+            last_seen=bindparam('_last_seen'))
+        with app.app_context():
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(update, [{'_id': user_id, '_last_seen': last_seen}
+                                                for user_id, last_seen in pending.items()])
+            except Exception as e:
+                # kept for the next flush; a page view must not fail over this
+                with self.lock:
+                    for user_id, last_seen in pending.items():
+                        if self.pending.get(user_id, last_seen) <= last_seen:
+                            self.pending[user_id] = last_seen
+                app.logger.warning('Could not write last seen times of %d users: %s', len(pending), e)
@@ -0,0 +1,186 @@
+import atexit
+import copy
+import hashlib
+import json
+import logging
+import os
+import sys
+from collections import deque
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+from queue import Full, Queue
+from time import time
+from flask import has_request_context, request
+from flask.logging import default_handler
+
+
+def fingerprint(record):
+    """What makes two errors the same one: the exception type and where it was raised through, or the log call."""
+    if record.exc_info and record.exc_info[0] is not None:
+        parts = [record.exc_info[0].__qualname__]
+        tb = record.exc_info[2]
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            parts.append('{}:{}:{}'.format(code.co_filename, code.co_name, tb.tb_lineno))
+            tb = tb.tb_next
+    else:
+        parts = [record.pathname, str(record.lineno), str(record.msg)]
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:12]
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without ever waiting for it.
+
+    Whatever needs the request or the live traceback is done here, in the
+    thread that logs: the message is rendered, the traceback turned into text
+    and fingerprinted. When the queue is full records are dropped and
+    counted, and the count is logged once there is room again.
+    """
+
+    def __init__(self, queue):
+        super(NonBlockingQueueHandler, self).__init__(queue)
+        self.dropped = 0
+        self.exceptions = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.levelno >= logging.ERROR:
+            record.fingerprint = fingerprint(record)
+        if record.exc_info:
+            record.exc_text = self.exceptions.formatException(record.exc_info)
+        if has_request_context():
+            record.request = {'method': request.method, 'path': request.full_path.rstrip('?'),
+                              'remote_addr': request.remote_addr}
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '{} log records were dropped, the log queue was full'.format(self.dropped)}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class Listener(QueueListener):
+    """A QueueListener that can be stopped more than once, and drains a full queue before it stops."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None:
+            super(Listener, self).stop()
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line; a ``fields`` dict passed as ``extra`` is merged into it."""
+
+    def format(self, record):
+        entry = {'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+                 'level': record.levelname, 'logger': record.name, 'message': record.getMessage(),
+                 'location': '{}:{}'.format(record.pathname, record.lineno)}
+        entry.update(getattr(record, 'fields', None) or {})
+        for name in ('request', 'fingerprint', 'exc_text'):
+            if getattr(record, name, None):
+                entry[name] = getattr(record, name)
+        return json.dumps(entry)
+
+
+class ThrottledSMTPHandler(SMTPHandler):
+    """Mails an error once per fingerprint and window, and at most ``limit`` mails per window.
+
+    What is held back is counted; the next mail about the same error says
+    how many were left out.
+    """
+
+    def __init__(self, *args, window=600, limit=10, **kwargs):
+        super(ThrottledSMTPHandler, self).__init__(*args, **kwargs)
+        self.window = window
+        self.limit = limit
+        self.sent = deque()
+        self.last_sent = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        if not super(ThrottledSMTPHandler, self).filter(record):
+            return False
+        now = time()
+        key = getattr(record, 'fingerprint', None) or fingerprint(record)
+        while self.sent and self.sent[0] <= now - self.window:
+            self.sent.popleft()
+        if now - self.last_sent.get(key, 0) < self.window or len(self.sent) >= self.limit:
+            self.suppressed[key] = (self.suppressed.get(key, (0, now))[0] + 1, now)
+            return False
+        self.sent.append(now)
+        self.last_sent[key] = now
+        record.suppressed = self.suppressed.pop(key, (0, now))[0]
+        for old in [k for k, t in self.last_sent.items() if t <= now - self.window]:
+            del self.last_sent[old]
+        # an error that stopped happening is not reported on anymore
+        for old in [k for k, (count, t) in self.suppressed.items() if t <= now - self.window]:
+            del self.suppressed[old]
+        return True
+
+    def getSubject(self, record):
+        subject = super(ThrottledSMTPHandler, self).getSubject(record)
+        if getattr(record, 'suppressed', 0):
+            subject += ' (+{} like it)'.format(record.suppressed)
+        return subject
+
+
+def init_logging(app):
+    """Send the app's logs through a queue to a listener thread that does the writing and mailing."""
+    config = app.config
+    handlers = []
+    if config['MAIL_SERVER']:
+        auth = None
+        if config['MAIL_USERNAME'] or config['MAIL_PASSWORD']:
+            auth = (config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+
+        secure = None
+        if config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = ThrottledSMTPHandler(
+            mailhost=(config['MAIL_SERVER'], config['MAIL_PORT']),
+            fromaddr='no-reply@' + config['MAIL_SERVER'],
+            toaddrs=config['ADMINS'], subject='Microblog Failure',
+            credentials=auth, secure=secure, window=config['LOG_MAIL_WINDOW'], limit=config['LOG_MAIL_LIMIT'])
+        mail_handler.setFormatter(
+            logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+
+    if config['LOG_TO_STDOUT']:
+        output = logging.StreamHandler(sys.stdout)
+    else:
+        directory = os.path.dirname(config['LOG_FILE'])
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        output = RotatingFileHandler(config['LOG_FILE'], maxBytes=config['LOG_MAX_BYTES'],
+                                     backupCount=config['LOG_BACKUP_COUNT'])
+    output.setFormatter(JSONFormatter())
+    output.setLevel(logging.INFO)
+    handlers.append(output)
+
+    if not config['LOG_TO_STDOUT']:
+        # warnings and errors still reach stderr, as with Flask's own handler
+        errors = logging.StreamHandler(sys.stderr)
+        errors.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(module)s: %(message)s'))
+        errors.setLevel(logging.WARNING)
+        handlers.append(errors)
+
+    queue_handler = NonBlockingQueueHandler(Queue(config['LOG_QUEUE_SIZE']))
+    listener = Listener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    app.extensions['log_listener'] = listener
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(queue_handler)
+    app.logger.setLevel(logging.INFO)
+    return listener
@@ -1,10 +1,20 @@
 from re import template
-from flask import render_template, flash, redirect, url_for, request, g, current_app
-from .. import db
+import re
+from time import time
+from flask import render_template, flash, redirect, url_for, request, g, current_app, Response, \
+    stream_with_context
+from werkzeug.urls import url_quote
+from werkzeug.wsgi import wrap_file
+from .. import db, chip_cache, csrf, last_seen, page_cache, stream
+from ..chip_import import ChipImporter, ImportFormatError, read_rows
+from ..conditional import conditional
+from ..database import replica_reads
+from ..chips import FIELDS, csv_stream, export_rows, lookup, parse_values, resolve_number, results_page, \
+    stream_csv, stream_json, xlsx_file
+from ..pagination import paginate
 from .forms import EditProfileForm, PostForm, SearchForm
 from flask_login import current_user, login_required
 from ..models import User, Post, ApprovalNo, WorkOrderNo, ProductCategory, ChipId
-from datetime import datetime
 from . import bp
 
 
@@ -12,8 +22,7 @@ from . import bp
 def before_request():
     g.search_form = SearchForm()
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen.touch(current_user)
 
 
 @bp.route('/', methods=['GET', 'POST'])
@@ -27,28 +36,65 @@ def index():
         db.session.commit()
         flash('Your post is now live!')
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    # next_url = url_for(
-    #     'index', page=posts.next_num) if posts.has_next else None
-    # prev_url = url_for(
-    #     'index', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title='Home', form=form, posts=posts.items, pagination=posts)
+
+    def render():
+        posts = paginate(current_user.home_timeline().options(db.joinedload(Post.author)),
+                         [Post.timestamp, Post.id])
+        # next_url = url_for(
+        #     'index', page=posts.next_num) if posts.has_next else None
+        # prev_url = url_for(
+        #     'index', page=posts.prev_num) if posts.has_prev else None
+        suggestions = current_user.recommended(current_app.config['RECOMMENDATIONS_SHOWN'])
+        return render_template('index.html', title='Home', form=form, posts=posts.items, pagination=posts,
+                               suggestions=suggestions)
+
+    # any new post may be on the timeline; the period keeps the form's CSRF token fresh
+    period = int(time() // ((current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) / 2))
+    return conditional((Post.latest(), current_user.followed_count, current_user.recommendations_version(),
+                        period), render)
 
 
 @bp.route('/user/<username>')
 @login_required
+@replica_reads
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    # next_url = url_for('user', username=user.username,
-    #                    page=posts.next_num) if posts.has_next else None
-    # prev_url = url_for('user', username=user.username,
-    #                    page=posts.prev_num) if posts.has_prev else None
-    return render_template('user.html', user=user, title='View Profile', posts=posts.items, pagination=posts)
+
+    def render():
+        posts = paginate(user.posts, [Post.timestamp, Post.id])
+        # next_url = url_for('user', username=user.username,
+        #                    page=posts.next_num) if posts.has_next else None
+        # prev_url = url_for('user', username=user.username,
+        #                    page=posts.prev_num) if posts.has_prev else None
+        suggestions = user.recommended(current_app.config['RECOMMENDATIONS_SHOWN']) \
+            if user == current_user else None
+        return render_template('user.html', user=user, title='View Profile', posts=posts.items, pagination=posts,
+                               suggestions=suggestions)
+
+    own = user == current_user
+    return conditional((user.username, user.email, user.about_me, user.last_seen, user.posts_count,
+                        user.followers_count, user.followed_count, Post.latest(user.id),
+                        None if own else current_user.is_following(user),
+                        user.recommendations_version() if own else None), render)
+
+
+@bp.route('/stream/timeline')
+@login_required
+def stream_timeline():
+    subscription = stream.subscribe(current_user)
+    backlog = []
+    last = request.headers.get('Last-Event-ID', type=int)
+    if last is not None:
+        backlog = [row[0] for row in db.session.query(Post.id).filter(
+            Post.id > last, Post.user_id.in_(subscription.authors)).order_by(Post.id).limit(
+            current_app.config['STREAM_BACKLOG'])]
+    # an idle stream must not hold a pooled connection; each event is
+    # rendered in a short session of its own
+    db.session.remove()
+    events = subscription.events(backlog, current_app.config['STREAM_HEARTBEAT'],
+                                 current_app.config['STREAM_TIMEOUT'])
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -101,15 +147,24 @@ def unfollow(username):
 
 @bp.route('/explore')
 @login_required
+@replica_reads
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    # next_url = url_for(
-    #     'index', page=posts.next_num) if posts.has_next else None
-    # prev_url = url_for(
-    #     'index', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title='Explore', posts=posts.items, pagination=posts)
+    def render_posts():
+        posts = paginate(Post.query.options(db.joinedload(Post.author)), [Post.timestamp, Post.id])
+        # next_url = url_for(
+        #     'index', page=posts.next_num) if posts.has_next else None
+        # prev_url = url_for(
+        #     'index', page=posts.prev_num) if posts.has_prev else None
+        return render_template('_posts.html', posts=posts.items, pagination=posts)
+
+    latest = Post.latest()
+
+    def render():
+        # keyed on the newest change, so a list cached before another process posted is not reused
+        post_list = page_cache.explore((latest,) + tuple(sorted(request.args.items(multi=True))), render_posts)
+        return render_template('index.html', title='Explore', post_list=post_list)
+
+    return conditional(latest, render, last_modified=max(filter(None, latest[1:]), default=None))
 
 
 @bp.route('/chipid_query', methods=['GET', 'POST'])
@@ -124,21 +179,23 @@ def chip_id():
 
 
 @bp.route('/chipid_results', methods=['GET', 'POST'])
+@replica_reads
 def chipid_results():
-    page = request.args.get('page', 1, type=int)
     field_query = request.args.get('field_query')
     product_category = request.args.getlist('product_category')
     method_query = request.args.get('method_query')
-    if method_query == "1":
-        pagination = db.session.query(ChipId).join(ApprovalNo).filter(
-            ApprovalNo.approval_no == field_query).join(ProductCategory).filter(
-            ProductCategory.product_category.in_(product_category)).paginate(
-            page, current_app.config['POSTS_PER_PAGE'], False)
-    else:
-        pagination = db.session.query(ChipId).join(WorkOrderNo).filter(
-            WorkOrderNo.work_order_no == field_query).join(ProductCategory).filter(
-            ProductCategory.product_category.in_(product_category)).paginate(
-            page, current_app.config['POSTS_PER_PAGE'], False)
+    limit = current_app.config['CHIPID_MATCH_LIMIT']
+    numbers = resolve_number(method_query, field_query, limit + 1)
+    if len(numbers) > 1:
+        args = dict(product_category=product_category, method_query=method_query)
+        return render_template('chipid_results.html', title='芯片ID查询结果', numbers=numbers[:limit],
+                               more=len(numbers) > limit, field_query=field_query, args=args)
+    if numbers:
+        field_query = numbers[0]
+    export = request.args.get('format')
+    if export in ('csv', 'xlsx'):
+        return export_results(export, method_query, field_query, product_category)
+    pagination = results_page(method_query, field_query, product_category)
     results = pagination.items
     # next_url = url_for(
     #     'chipid_results', field_query=field_query, product_category=product_category,
@@ -150,17 +207,99 @@ def chipid_results():
     return render_template('chipid_results.html', title='芯片ID查询结果', results=results, pagination=pagination, args=args)
 
 
+def export_results(export, method_query, field_query, product_category):
+    rows = export_rows(method_query, field_query, product_category)
+    # the numbers may be typed in Chinese: an ASCII name for old clients, the
+    # full one percent-encoded (RFC 6266) for the others
+    filename = 'chipid_{}.{}'.format(re.sub(r'[^\w.-]+', '_', field_query or ''), export)
+    headers = {'Content-Disposition': 'attachment; filename="{}"; filename*=UTF-8\'\'{}'.format(
+        filename.encode('ascii', 'replace').decode('ascii').replace('?', '_'), url_quote(filename, safe=''))}
+    if export == 'csv':
+        return Response(stream_with_context(csv_stream(FIELDS, rows, bom=True)), mimetype='text/csv',
+                        headers=headers)
+    try:
+        f = xlsx_file(FIELDS, rows)
+    except ImportError:
+        flash('导出Excel需要安装openpyxl，请导出CSV')
+        return redirect(url_for('main.chipid_results', field_query=field_query,
+                                product_category=product_category, method_query=method_query))
+    return Response(wrap_file(request.environ, f), headers=headers, direct_passthrough=True,
+                    mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+
+@bp.route('/cache_stats')
+@login_required
+def cache_stats():
+    return page_cache.stats()
+
+
+@bp.route('/chipid_cache')
+@login_required
+def chipid_cache():
+    return chip_cache.stats()
+
+
+@bp.route('/chipid_import', methods=['GET', 'POST'])
+@login_required
+def chipid_import():
+    importer = None
+    if request.method == "POST":
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('请选择要导入的CSV或Excel文件')
+            return redirect(url_for('main.chipid_import'))
+        importer = ChipImporter(current_app.config['CHIPID_IMPORT_BATCH_SIZE'],
+                                request.form.get('on_duplicate') != 'skip')
+        try:
+            importer.run(read_rows(upload.stream, upload.filename))
+        except ImportFormatError as e:
+            flash(str(e))
+            return redirect(url_for('main.chipid_import'))
+    return render_template('chipid_import.html', title='芯片ID导入', importer=importer)
+
+
+@bp.route('/chipid_lookup', methods=['GET', 'POST'])
+@csrf.exempt
+def chipid_lookup():
+    if request.method == "GET":
+        return render_template('chipid_lookup.html', title='芯片ID批量查询')
+    if request.is_json:
+        data = request.get_json()
+        values = data.get('values') if isinstance(data, dict) else None
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            return {'error': 'Expected a JSON object with a list of strings as "values".'}, 400
+        by, values, output = data.get('by'), list(dict.fromkeys(values)), 'json'
+    else:
+        by, output = request.form.get('by'), request.form.get('format')
+        text = request.form.get('values', '')
+        upload = request.files.get('file')
+        if upload and upload.filename:
+            text += '\n' + upload.read().decode('utf-8-sig', 'replace')
+        values = parse_values(text)
+    by = 'asset_no' if by == 'asset_no' else 'chip_id'
+    if not values:
+        return {'error': 'No values to look up.'}, 400
+    if len(values) > current_app.config['CHIPID_LOOKUP_MAX']:
+        return {'error': 'At most {} values can be looked up at once.'.format(
+            current_app.config['CHIPID_LOOKUP_MAX'])}, 413
+    results = lookup([str(value) for value in values], by)
+    if output == 'json':
+        return Response(stream_with_context(stream_json(results, by)), mimetype='application/json')
+    return Response(stream_with_context(stream_csv(results)), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=chipid_lookup.csv'})
+
+
 @bp.route('/search')
+@replica_reads
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     page = request.args.get('page', 1, type=int)
     posts, total = Post.search(g.search_form.q.data, page,
                                current_app.config['POSTS_PER_PAGE'])
-    print(total)
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) if total['value'] > page * \
-                                                                                current_app.config[
-                                                                                    'POSTS_PER_PAGE'] else None
+    posts = posts.options(db.joinedload(Post.author))
+    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
+        if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) if page > 1 else None
     return render_template('search.html', title='Search', posts=posts,
                            next_url=next_url, prev_url=prev_url)
@@ -0,0 +1,186 @@
+import logging
+from bisect import bisect_left
+from collections import defaultdict, deque
+from threading import Lock
+from time import perf_counter, time
+from flask import Response, abort, current_app, g, has_request_context, request, request_finished, \
+    request_started, request_tearing_down
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """The numbers of one application, as kept by this process."""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = Lock()
+        self.latency = defaultdict(Histogram)
+        self.requests = defaultdict(int)
+        self.queries = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+        self.slow_queries = deque(maxlen=app.config['METRICS_SLOW_QUERY_SAMPLES'])
+        self.logger = logging.getLogger('app.metrics')
+
+    def record_request(self, endpoint, method, status, duration, queries, db_seconds):
+        with self.lock:
+            self.latency[(endpoint, method)].observe(duration)
+            self.requests[(endpoint, method, status)] += 1
+            self.queries[endpoint] += queries
+            self.db_seconds[endpoint] += db_seconds
+        if self.app.config['METRICS_LOG']:
+            fields = {'endpoint': endpoint, 'method': method, 'status': status,
+                      'duration_ms': round(duration * 1000, 2), 'queries': queries,
+                      'db_ms': round(db_seconds * 1000, 2)}
+            self.logger.info('%s %s %s in %sms', method, endpoint, status, fields['duration_ms'],
+                             extra={'fields': fields})
+
+    def record_slow_query(self, endpoint, statement, duration):
+        sample = {'time': time(), 'endpoint': endpoint, 'duration_ms': round(duration * 1000, 2),
+                  'statement': statement}
+        with self.lock:
+            self.slow_queries.append(sample)
+        self.logger.warning('Slow query in %s (%sms): %s', endpoint, sample['duration_ms'], statement,
+                            extra={'fields': sample})
+
+    def render(self):
+        """Everything in the Prometheus text format."""
+        lines = []
+
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        with self.lock:
+            lines.append('# HELP microblog_request_duration_seconds Time spent handling requests.')
+            lines.append('# TYPE microblog_request_duration_seconds histogram')
+            for (endpoint, method), histogram in sorted(self.latency.items()):
+                labels = 'endpoint="{}",method="{}"'.format(label(endpoint), method)
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('microblog_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                        labels, bound, cumulative))
+                lines.append('microblog_request_duration_seconds_sum{{{}}} {}'.format(labels, histogram.sum))
+                lines.append('microblog_request_duration_seconds_count{{{}}} {}'.format(labels, histogram.count))
+            lines.append('# HELP microblog_requests_total Requests by response status.')
+            lines.append('# TYPE microblog_requests_total counter')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append('microblog_requests_total{{endpoint="{}",method="{}",status="{}"}} {}'.format(
+                    label(endpoint), method, status, count))
+            lines.append('# HELP microblog_db_queries_total SQL statements run while handling requests.')
+            lines.append('# TYPE microblog_db_queries_total counter')
+            for endpoint, count in sorted(self.queries.items()):
+                lines.append('microblog_db_queries_total{{endpoint="{}"}} {}'.format(label(endpoint), count))
+            lines.append('# HELP microblog_db_seconds_total Time spent in SQL statements while handling requests.')
+            lines.append('# TYPE microblog_db_seconds_total counter')
+            for endpoint, seconds in sorted(self.db_seconds.items()):
+                lines.append('microblog_db_seconds_total{{endpoint="{}"}} {}'.format(label(endpoint), seconds))
+        return '\n'.join(lines) + '\n'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's context, which goes away with it when the statement fails
+    if context is not None:
+        context.metrics_start = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'metrics_start', None)
+    if start is None:
+        return
+    duration = perf_counter() - start
+    if not has_request_context() or 'metrics' not in g:
+        return
+    timing = g.metrics
+    timing['queries'] += 1
+    timing['db_seconds'] += duration
+    if duration >= timing['slow']:
+        current_app.extensions['metrics'].record_slow_query(request.endpoint, statement, duration)
+
+
+class Metrics(object):
+    """Per-endpoint latency, SQL statement counts and time, and slow queries.
+
+    Requests are timed from Flask's request_started to request_tearing_down
+    signals, which for a streamed response is when the stream ends, and SQL
+    statements by engine events, so nothing is added to the views. Statements
+    slower than METRICS_SLOW_QUERY seconds are kept and logged as warnings.
+    The numbers belong to one process; scrape each worker, or run one.
+
+    The numbers are served at /metrics in the Prometheus text format, with
+    the latest slow statements at /metrics/slow_queries. With METRICS_TOKEN
+    set they require it as a bearer token; without it they are only served
+    to requests made on this host and not passed on by a proxy. METRICS_LOG
+    also logs one line per request, with these numbers as fields, to
+    ``app.metrics``.
+    """
+
+    def __init__(self, app=None):
+        self.listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['METRICS_ENABLED']:
+            return
+        app.extensions['metrics'] = Registry(app)
+        if not self.listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            self.listening = True
+        request_started.connect(self._started, app)
+        request_finished.connect(self._responded, app)
+        request_tearing_down.connect(self._finished, app)
+        app.add_url_rule('/metrics', 'metrics', self._export)
+        app.add_url_rule('/metrics/slow_queries', 'slow_queries', self._slow_queries)
+
+    @staticmethod
+    def _started(sender, **extra):
+        g.metrics = {'start': perf_counter(), 'queries': 0, 'db_seconds': 0.0,
+                     'slow': sender.config['METRICS_SLOW_QUERY']}
+
+    @staticmethod
+    def _responded(sender, response, **extra):
+        g.metrics_status = response.status_code
+
+    @staticmethod
+    def _finished(sender, exc=None, **extra):
+        timing = g.pop('metrics', None)
+        if timing is None:
+            return
+        status = getattr(g, 'metrics_status', 500 if exc is not None else 200)
+        sender.extensions['metrics'].record_request(
+            request.endpoint or 'none', request.method, status, perf_counter() - timing['start'],
+            timing['queries'], timing['db_seconds'])
+
+    @staticmethod
+    def _authorize():
+        token = current_app.config['METRICS_TOKEN']
+        if token:
+            if request.headers.get('Authorization') != 'Bearer ' + token:
+                abort(403)
+        elif request.remote_addr not in ('127.0.0.1', '::1') or 'X-Forwarded-For' in request.headers:
+            # the slow queries hold raw SQL
+            abort(403)
+
+    def _export(self):
+        self._authorize()
+        return Response(current_app.extensions['metrics'].render(), mimetype='text/plain; version=0.0.4')
+
+    def _slow_queries(self):
+        self._authorize()
+        return {'slow_queries': list(current_app.extensions['metrics'].slow_queries)}
@@ -1,21 +1,43 @@
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
-from . import db
+from . import db, passwords
 from flask_login import UserMixin
 from . import login
+from functools import lru_cache
 from hashlib import md5
 from time import time
 import jwt
 from flask import current_app
 
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import document, query_index
+from app import jobs, page_cache, search_indexer, stream, timeline
+from app.indexer import Reindexer
+from app.recommendations import recommendation
 
+
+@lru_cache(maxsize=4096)
+def avatar_hash(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+# an existing database keeps its duplicate follows until 'flask users dedupe-follows'
+# removes them; only then can the unique constraint be added to it
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+                     db.UniqueConstraint('follower_id', 'followed_id', name='uq_followers_follower_id_followed_id'),
+                     db.Index('ix_followers_followed_id', 'followed_id', 'follower_id')
                      )
 
 
+def _add(obj, name, delta):
+    # an UPDATE ... SET n = n + delta for stored rows, so concurrent changes are not lost
+    state = db.inspect(obj)
+    if state.persistent:
+        setattr(obj, name, getattr(state.class_, name) + delta)
+    else:
+        setattr(obj, name, (getattr(obj, name) or 0) + delta)
+
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
@@ -23,6 +45,11 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128))
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # last change of what pages show of the user next to their posts
+    profile_changed = db.Column(db.DateTime, index=True)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     followed = db.relationship(
         'User', secondary=followers,
@@ -48,26 +75,85 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Check the password, rehashing it if the stored hash uses outdated parameters."""
+        if not self.password_hash or not passwords.verify(self.password_hash, password):
+            return False
+        if passwords.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        digest = avatar_hash(self.email)
         return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            _add(self, 'followed_count', 1)
+            _add(user, 'followers_count', 1)
+            timeline.follow(self, user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            _add(self, 'followed_count', -1)
+            _add(user, 'followers_count', -1)
+            timeline.unfollow(self, user)
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return db.session.query(db.exists().where(db.and_(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id))).scalar()
+
+    @staticmethod
+    def reconcile_counts():
+        """Recount followers, followed users and posts where the counters drifted.
+
+        Returns the number of users that were repaired.
+        """
+        table = User.__table__
+        counts = {
+            'followers_count': db.select([db.func.count()]).where(
+                followers.c.followed_id == table.c.id).as_scalar(),
+            'followed_count': db.select([db.func.count()]).where(
+                followers.c.follower_id == table.c.id).as_scalar(),
+            'posts_count': db.select([db.func.count()]).where(
+                Post.__table__.c.user_id == table.c.id).as_scalar(),
+        }
+        result = db.session.execute(table.update().where(
+            db.or_(*[table.c[name] != count for name, count in counts.items()])).values(counts))
+        db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def remove_duplicate_follows():
+        """Keep one row of every follow stored more than once.
+
+        Returns the number of rows removed.
+        """
+        pairs = [followers.c.follower_id, followers.c.followed_id]
+        duplicates = db.session.execute(db.select(pairs + [db.func.count()]).group_by(*pairs).having(
+            db.func.count() > 1)).fetchall()
+        for follower_id, followed_id, count in duplicates:
+            db.session.execute(followers.delete().where(followers.c.follower_id == follower_id).where(
+                followers.c.followed_id == followed_id))
+            db.session.execute(followers.insert().values(follower_id=follower_id, followed_id=followed_id))
+        db.session.commit()
+        return sum(count - 1 for follower_id, followed_id, count in duplicates)
+
+    def recommended(self, limit):
+        """Users suggested by the last recommendation batch, minus the ones followed since."""
+        return User.query.join(recommendation, recommendation.c.candidate_id == User.id).filter(
+            recommendation.c.user_id == self.id).filter(~db.exists().where(db.and_(
+                followers.c.follower_id == self.id, followers.c.followed_id == User.id))).order_by(
+            recommendation.c.score.desc(), User.id).limit(limit).all()
+
+    def recommendations_version(self):
+        """Changes whenever the stored suggestions for this user do."""
+        return tuple(db.session.query(db.func.count(), db.func.sum(recommendation.c.score)).filter(
+            recommendation.c.user_id == self.id).one())
 
     def followed_posts(self):
         followed = Post.query.join(
@@ -76,6 +162,11 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def home_timeline(self):
+        if timeline.is_enabled():
+            return timeline.home_timeline(self)
+        return self.followed_posts()
+
 
 class SearchableMixin(object):
     @classmethod
@@ -89,27 +180,31 @@ class SearchableMixin(object):
         return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': [obj for obj in session.new if isinstance(obj, cls)],
-            'update': [obj for obj in session.dirty if isinstance(obj, cls)],
-            'delete': [obj for obj in session.deleted if isinstance(obj, cls)]
-        }
+    def after_flush(cls, session, flush_context):
+        # snapshot the documents while ids are assigned and attributes loaded
+        changes = session.info.setdefault(cls.__tablename__ + '_search_changes', {})
+        for obj in session.new:
+            if isinstance(obj, cls):
+                changes[obj.id] = document(obj)
+        for obj in session.dirty:
+            if isinstance(obj, cls):
+                changes[obj.id] = document(obj)
+        for obj in session.deleted:
+            if isinstance(obj, cls):
+                changes[obj.id] = None
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            add_to_index(cls.__tablename__, obj)
-        for obj in session._changes['update']:
-            add_to_index(cls.__tablename__, obj)
-        for obj in session._changes['delete']:
-            remove_from_index(cls.__tablename__, obj)
-        session._changes = None
+        changes = session.info.pop(cls.__tablename__ + '_search_changes', {})
+        search_indexer.put(cls.__tablename__, changes)
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def after_rollback(cls, session):
+        session.info.pop(cls.__tablename__ + '_search_changes', None)
+
+    @classmethod
+    def reindex(cls, chunk_size=1000, workers=1):
+        return Reindexer(cls, chunk_size, workers).run()
 
 
 class Post(SearchableMixin, db.Model):
@@ -118,13 +213,56 @@ class Post(SearchableMixin, db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     __searchable__ = ['body']
+    __table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
+
+    @staticmethod
+    def latest(user_id=None):
+        """The highest id, newest timestamp and last author rename of all posts, or of one user's."""
+        def newest(column, owner):
+            query = db.select([db.func.max(column)])
+            if user_id is not None:
+                query = query.where(owner == user_id)
+            return query.as_scalar()
+        return tuple(db.session.query(newest(Post.id, Post.user_id), newest(Post.timestamp, Post.user_id),
+                                      newest(User.profile_changed, User.id)).one())
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
 
-db.event.listen(db.session, 'before_commit', Post.before_commit)
+def count_posts(session, flush_context, instances):
+    changes = {}
+    for objects, delta in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            if isinstance(obj, Post):
+                author = obj.author or (obj.user_id and User.query.get(obj.user_id))
+                if author:
+                    changes[author] = changes.get(author, 0) + delta
+    for author, delta in changes.items():
+        _add(author, 'posts_count', delta)
+
+
+def mark_profile_changes(session, flush_context, instances):
+    for obj in session.dirty:
+        if isinstance(obj, User) and any(
+                db.inspect(obj).attrs[name].history.has_changes() for name in ('username', 'email')):
+            obj.profile_changed = datetime.utcnow()
+
+
+db.event.listen(db.session, 'before_flush', count_posts)
+db.event.listen(db.session, 'before_flush', mark_profile_changes)
+db.event.listen(db.session, 'after_flush', Post.after_flush)
 db.event.listen(db.session, 'after_commit', Post.after_commit)
+db.event.listen(db.session, 'after_rollback', Post.after_rollback)
+db.event.listen(db.session, 'after_flush', timeline.after_flush)
+db.event.listen(db.session, 'after_flush', page_cache.after_flush)
+db.event.listen(db.session, 'after_commit', page_cache.after_commit)
+db.event.listen(db.session, 'after_rollback', page_cache.after_rollback)
+db.event.listen(db.session, 'after_flush', stream.after_flush)
+db.event.listen(db.session, 'after_commit', stream.after_commit)
+db.event.listen(db.session, 'after_rollback', stream.after_rollback)
+db.event.listen(db.session, 'after_commit', jobs.after_commit)
+db.event.listen(db.session, 'after_rollback', jobs.after_rollback)
 
 
 @login.user_loader
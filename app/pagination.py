@@ -0,0 +1,175 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from time import time
+from flask import current_app, request, url_for
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(direction, values):
+    payload = [direction] + [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, columns):
+    """Return ``(direction, values)`` for a cursor token, or None if it is not valid."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if not isinstance(payload, list) or not payload:
+            return None
+        direction, values = payload[0], payload[1:]
+        if direction not in ('n', 'p') or len(values) != len(columns):
+            return None
+        decoded = []
+        # only values of the column's own type may reach the SQL comparisons
+        for column, value in zip(columns, values):
+            value = _decode_value(_python_type(column), value)
+            if value is None:
+                return None
+            decoded.append(value)
+        return direction, decoded
+    except (binascii.Error, ValueError, TypeError, IndexError):
+        return None
+
+
+def _python_type(column):
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return None
+
+
+def _decode_value(python_type, value):
+    """``value`` as a ``python_type``, or None when it is not one."""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    if python_type is datetime:
+        return datetime.fromisoformat(value) if isinstance(value, str) else None
+    if python_type is float:
+        return float(value) if isinstance(value, (int, float)) else None
+    if python_type in (int, str):
+        return value if isinstance(value, python_type) else None
+    return value
+
+
+def _beyond(columns, values, descending):
+    """Rows strictly after ``values`` in lexicographic ``columns`` order."""
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        clauses.append(and_(*(equal + [column < values[i] if descending else column > values[i]])))
+    return or_(*clauses)
+
+
+def _count(query):
+    counts = current_app.extensions.setdefault('pagination_counts', {})
+    compiled = query.statement.compile()
+    key = str(compiled) + repr(sorted(compiled.params.items()))
+    cached = counts.get(key)
+    if cached is not None and cached[0] > time():
+        return cached[1]
+    if len(counts) >= current_app.config['PAGINATION_COUNT_CACHE_SIZE']:
+        counts.clear()
+    total = query.order_by(None).count()
+    counts[key] = (time() + current_app.config['PAGINATION_COUNT_TTL'], total)
+    return total
+
+
+def forget_counts():
+    current_app.extensions.pop('pagination_counts', None)
+
+
+def _url(cursor):
+    if cursor is None:
+        return None
+    args = request.args.to_dict(flat=False)
+    args.pop('page', None)
+    args.update(request.view_args or {})
+    args['cursor'] = cursor
+    return url_for(request.endpoint, **args)
+
+
+class KeysetPagination(object):
+    """One page of a query walked in ``columns`` order with ``?cursor=`` tokens.
+
+    The last column must be unique so that every row has a distinct position.
+    A plain ``?page=`` number is still honoured for old links, after which the
+    next and previous links switch to cursors.
+    """
+
+    def __init__(self, query, columns, per_page, descending=True, count=False):
+        self.per_page = per_page
+        cursor = decode_cursor(request.args.get('cursor', ''), columns)
+        page = request.args.get('page', 1, type=int)
+        forward = cursor is None or cursor[0] == 'n'
+        reverse = descending == forward
+        q = query.order_by(None).add_columns(*columns)
+        if cursor is not None:
+            q = q.filter(_beyond(columns, cursor[1], reverse))
+        q = q.order_by(*[c.desc() if reverse else c.asc() for c in columns])
+        if cursor is None and page > 1:
+            q = q.offset((page - 1) * per_page)
+        rows = q.limit(per_page + 1).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if not forward:
+            rows.reverse()
+        self.items = [row[0] for row in rows]
+        self._keys = [tuple(row[1:]) for row in rows]
+        if forward:
+            self.has_next = more
+            self.has_prev = cursor is not None or page > 1
+        else:
+            self.has_next = True
+            self.has_prev = more
+        self.total = _count(query) if count else None
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self._keys:
+            return encode_cursor('n', self._keys[-1])
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self._keys:
+            return encode_cursor('p', self._keys[0])
+
+    @property
+    def next_url(self):
+        return _url(self.next_cursor)
+
+    @property
+    def prev_url(self):
+        return _url(self.prev_cursor)
+
+    def to_dict(self, items=None):
+        """This page as plain data for a cache; ``items`` replaces the query results."""
+        return {'items': self.items if items is None else items, 'has_next': self.has_next,
+                'has_prev': self.has_prev, 'next_cursor': self.next_cursor,
+                'prev_cursor': self.prev_cursor, 'total': self.total}
+
+
+class CachedPage(object):
+    """A page rebuilt from ``KeysetPagination.to_dict()``, with the same links."""
+
+    def __init__(self, items, has_next, has_prev, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def next_url(self):
+        return _url(self.next_cursor)
+
+    @property
+    def prev_url(self):
+        return _url(self.prev_cursor)
+
+
+def paginate(query, columns, per_page=None, descending=True, count=False):
+    return KeysetPagination(query, columns, per_page or current_app.config['POSTS_PER_PAGE'],
+                            descending=descending, count=count)
@@ -0,0 +1,91 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import time
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(ServiceUnavailable):
+    description = 'Too many sign-ins are being processed right now. Please try again in a moment.'
+
+
+class PasswordHasher(object):
+    """Runs password hashing on a pool of PASSWORD_HASH_WORKERS threads.
+
+    PBKDF2 releases the GIL, so the pool hashes in parallel while request
+    threads only wait. At most PASSWORD_HASH_QUEUE hashes may be queued or
+    running; past that ``HashingBusy`` (a 503) is raised straight away
+    instead of letting requests pile up.
+    """
+
+    def __init__(self, app=None):
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['passwords'] = {'executor': None, 'slots': None}
+
+    def _pool(self):
+        state = current_app.extensions['passwords']
+        if state['executor'] is None:
+            with self.lock:
+                if state['executor'] is None:
+                    workers = current_app.config['PASSWORD_HASH_WORKERS'] or os.cpu_count() or 1
+                    state['slots'] = BoundedSemaphore(current_app.config['PASSWORD_HASH_QUEUE'] or 4 * workers)
+                    state['executor'] = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+        return state['executor'], state['slots']
+
+    def _run(self, f, *args):
+        executor, slots = self._pool()
+        if not slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            return executor.submit(f, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'],
+                         current_app.config['PASSWORD_SALT_LENGTH'])
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    @staticmethod
+    def needs_rehash(pwhash):
+        """Whether ``pwhash`` was made with other parameters than the configured ones."""
+        method, salt = pwhash.split('$', 2)[:2] if pwhash.count('$') >= 2 else ('', '')
+        wanted = current_app.config['PASSWORD_HASH_METHOD']
+        # a method given without iterations is stored with Werkzeug's default count
+        return (method != wanted and not method.startswith(wanted + ':')) or \
+            len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
+
+    def benchmark(self, seconds=5.0, clients=None):
+        """Verify one password from ``clients`` threads for ``seconds``; returns the rates."""
+        app = current_app._get_current_object()
+        pwhash = self.hash('benchmark')
+        clients = clients or 2 * (app.config['PASSWORD_HASH_WORKERS'] or os.cpu_count() or 1)
+        counts = {'ok': 0, 'busy': 0}
+        deadline = time() + seconds
+
+        def client():
+            with app.app_context():
+                while time() < deadline:
+                    try:
+                        self.verify(pwhash, 'benchmark')
+                        key = 'ok'
+                    except HashingBusy:
+                        key = 'busy'
+                    with self.lock:
+                        counts[key] += 1
+
+        with ThreadPoolExecutor(clients) as pool:
+            for i in range(clients):
+                pool.submit(client)
+        cores = os.cpu_count() or 1
+        return {'logins_per_second': counts['ok'] / seconds, 'cores': cores,
+                'logins_per_second_per_core': counts['ok'] / seconds / cores,
+                'rejected': counts['busy']}
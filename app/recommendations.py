@@ -0,0 +1,95 @@
+import heapq
+import random
+from array import array
+from collections import defaultdict
+from itertools import accumulate, islice
+from time import time
+from app import db
+
+# "Who to follow", rebuilt in batch by ``flask users recommend``. A candidate
+# scores one point for every account the user follows that follows it
+# (friends of friends); the best RECOMMENDATIONS_TOP_K are kept per user.
+recommendation = db.Table('recommendation',
+                          db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                          db.Column('candidate_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                          db.Column('score', db.Integer, nullable=False),
+                          db.Index('ix_recommendation_user_id_score', 'user_id', 'score')
+                          )
+
+
+def adjacency(edges):
+    """``{follower: array of followed ids}`` for ``(follower, followed)`` pairs."""
+    following = defaultdict(lambda: array('l'))
+    for follower, followed in edges:
+        following[follower].append(followed)
+    return following
+
+
+def compute(following, top_k=10, max_fanout=1000):
+    """Yield ``(user, [(candidate, score), ...])`` for every user with candidates.
+
+    Only the first ``max_fanout`` accounts of each list are walked, which
+    bounds the work spent on users who follow a great many accounts.
+    """
+    for user, followed in following.items():
+        seen = set(followed)
+        seen.add(user)
+        scores = defaultdict(int)
+        for friend in islice(followed, max_fanout):
+            for candidate in islice(following.get(friend, ()), max_fanout):
+                if candidate not in seen:
+                    scores[candidate] += 1
+        if scores:
+            yield user, heapq.nlargest(top_k, scores.items(), key=lambda item: (item[1], -item[0]))
+
+
+def store(results, chunk_size=10000):
+    """Replace the stored recommendations in one transaction; returns the number of rows."""
+    db.session.execute(recommendation.delete())
+    count = 0
+    rows = []
+    for user, candidates in results:
+        rows.extend({'user_id': user, 'candidate_id': candidate, 'score': score}
+                    for candidate, score in candidates)
+        if len(rows) >= chunk_size:
+            db.session.execute(recommendation.insert(), rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        db.session.execute(recommendation.insert(), rows)
+        count += len(rows)
+    db.session.commit()
+    return count
+
+
+def rebuild(top_k=10, max_fanout=1000, chunk_size=10000):
+    """Recompute the recommendations of every user from the followers table."""
+    from app.models import followers
+    edges = db.session.query(followers.c.follower_id, followers.c.followed_id).yield_per(chunk_size)
+    return store(compute(adjacency(edges), top_k, max_fanout), chunk_size)
+
+
+def synthetic_graph(users, follows, seed=0):
+    """Edges of a random follower graph where a few users attract most follows."""
+    rng = random.Random(seed)
+    # Zipf-like popularity: user i is picked with weight 1 / (i + 1)
+    cum_weights = list(accumulate(1.0 / (i + 1) for i in range(users)))
+    for follower in range(users):
+        picked = set(rng.choices(range(users), cum_weights=cum_weights, k=rng.randint(1, 2 * follows)))
+        picked.discard(follower)
+        for followed in picked:
+            yield follower, followed
+
+
+def benchmark(users, follows, top_k=10, max_fanout=1000, seed=0):
+    """Time the batch over a synthetic graph; returns a dict of measurements."""
+    import resource
+    start = time()
+    following = adjacency(synthetic_graph(users, follows, seed))
+    edges = sum(len(followed) for followed in following.values())
+    loaded = time()
+    rows = sum(len(candidates) for user, candidates in compute(following, top_k, max_fanout))
+    done = time()
+    return {'users': users, 'edges': edges, 'rows': rows, 'load_seconds': loaded - start,
+            'compute_seconds': done - loaded, 'edges_per_second': edges / max(done - loaded, 1e-6),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
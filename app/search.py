@@ -1,26 +1,58 @@
 from flask import current_app
+from werkzeug.utils import import_string
+from app.search_backends import BACKENDS
 
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
+def create_backend(app):
+    """Build the backend named by SEARCH_BACKEND.
+
+    It defaults to Elasticsearch when ELASTICSEARCH_URL is set and to the
+    embedded SQLite backend otherwise. ``none`` switches search off and any
+    other value is imported as ``module:Class``.
+    """
+    name = app.config['SEARCH_BACKEND'] or ('elasticsearch' if app.config['ELASTICSEARCH_URL'] else 'sqlite')
+    if name == 'none':
+        return None
+    backend = BACKENDS[name] if name in BACKENDS else import_string(name)
+    return backend(app)
+
+
+def document(model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id, body=payload)
+    return payload
+
+
+def add_to_index(index, model):
+    bulk_index([((index, model.id), document(model))])
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    bulk_index([((index, model.id), None)])
+
+
+def bulk_index(changes):
+    """Apply ``((index, id), payload)`` pairs in one request.
+
+    A payload of None removes the document. Returns the keys of the changes
+    that failed in a way worth retrying.
+    """
+    if not current_app.search_backend or not changes:
+        return []
+    return current_app.search_backend.bulk(changes)
+
+
+def create_index(index):
+    current_app.search_backend.create_index(index)
+
+
+def point_alias(alias, index):
+    """Atomically serve ``index`` under the name ``alias``, dropping what it replaced."""
+    current_app.search_backend.point_alias(alias, index)
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(index=index, doc_type=index,
-                                              body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-                                                    'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']
+    return current_app.search_backend.query(index, query, page, per_page)
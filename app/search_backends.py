@@ -0,0 +1,176 @@
+import re
+import sqlite3
+from threading import Lock
+
+# A search backend stores ``{field: text}`` documents under an index name and
+# an integer id. It implements:
+#
+#   bulk(changes)        apply ``((index, id), payload)`` pairs, a payload of
+#                        None removing the document; returns the keys that
+#                        should be retried
+#   query(index, query, page, per_page)
+#                        ranked ids of one page of matches, and the total
+#   create_index(index)  prepare an empty index for a rebuild
+#   point_alias(alias, index)
+#                        make ``index`` the one served under ``alias``
+#
+# and is built from the application with ``Backend(app)``.
+
+
+_client_lock = Lock()
+
+
+def elasticsearch_client(app):
+    """The Elasticsearch client of ``app``, built on first use.
+
+    The ``elasticsearch`` package is only imported then, so processes that
+    never search do not pay for it.
+    """
+    if app.elasticsearch is None and app.config['ELASTICSEARCH_URL']:
+        with _client_lock:
+            if app.elasticsearch is None:
+                from elasticsearch import Elasticsearch
+                app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']])
+    return app.elasticsearch
+
+
+class ElasticsearchBackend(object):
+    def __init__(self, app):
+        self.app = app
+
+    @property
+    def client(self):
+        return elasticsearch_client(self.app)
+
+    def bulk(self, changes):
+        body = []
+        for (index, id), payload in changes:
+            if payload is None:
+                body.append({'delete': {'_index': index, '_id': id}})
+            else:
+                body.append({'index': {'_index': index, '_id': id}})
+                body.append(payload)
+        response = self.client.bulk(body=body)
+        failed = []
+        if response.get('errors'):
+            # items come back in request order, named by the concrete index
+            # behind an alias; the caller's own keys are returned
+            for (key, payload), item in zip(changes, response['items']):
+                result = list(item.values())[0]
+                if result.get('status') == 429 or result.get('status', 0) >= 500:
+                    failed.append(key)
+        return failed
+
+    def query(self, index, query, page, per_page):
+        search = self.client.search(index=index,
+                                    body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                                          'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        total = search['hits']['total']
+        return ids, total['value'] if isinstance(total, dict) else total
+
+    def create_index(self, index):
+        self.client.indices.create(index=index)
+
+    def point_alias(self, alias, index):
+        # a concrete index that has the alias' name, as created before aliases
+        # were used, is removed in the same step
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        old = []
+        if self.client.indices.exists_alias(name=alias):
+            old = [name for name in self.client.indices.get_alias(name=alias) if name != index]
+            actions += [{'remove': {'index': name, 'alias': alias}} for name in old]
+        elif self.client.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        for name in old:
+            self.client.indices.delete(index=name)
+
+
+class SQLiteBackend(object):
+    """Embedded full-text search in an SQLite FTS5 file, ranked with BM25.
+
+    Each index is an FTS5 table whose rowid is the document id and whose
+    columns are the searchable fields. Query words are matched with OR, as a
+    ``multi_match`` query does in Elasticsearch.
+    """
+
+    def __init__(self, app):
+        path = app.config['SEARCH_SQLITE_PATH']
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.lock = Lock()
+        self.fields = {}
+
+    @staticmethod
+    def _quote(name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def _fields(self, index, payload=None):
+        if index not in self.fields:
+            fields = [row[1] for row in self.db.execute(
+                'PRAGMA table_info({})'.format(self._quote(index)))]
+            if not fields and payload is None:
+                return []
+            if not fields:
+                fields = sorted(payload)
+                self.db.execute('CREATE VIRTUAL TABLE {} USING fts5({})'.format(
+                    self._quote(index), ', '.join(self._quote(field) for field in fields)))
+            self.fields[index] = fields
+        return self.fields[index]
+
+    def bulk(self, changes):
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                for (index, id), payload in changes:
+                    fields = self._fields(index, payload)
+                    if not fields:
+                        continue
+                    table = self._quote(index)
+                    self.db.execute('DELETE FROM {} WHERE rowid = ?'.format(table), (id,))
+                    if payload is not None:
+                        self.db.execute('INSERT INTO {}(rowid, {}) VALUES (?{})'.format(
+                            table, ', '.join(self._quote(field) for field in fields), ', ?' * len(fields)),
+                            [id] + [payload.get(field) for field in fields])
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                self.fields.clear()
+                raise
+        return []
+
+    def query(self, index, query, page, per_page):
+        words = re.findall(r'\w+', query)
+        with self.lock:
+            if not words or not self._fields(index):
+                return [], 0
+            table = self._quote(index)
+            match = ' OR '.join('"{}"'.format(word) for word in words)
+            ids = [row[0] for row in self.db.execute(
+                'SELECT rowid FROM {0} WHERE {0} MATCH ? ORDER BY bm25({0}) LIMIT ? OFFSET ?'.format(table),
+                (match, per_page, (page - 1) * per_page))]
+            total = self.db.execute('SELECT count(*) FROM {0} WHERE {0} MATCH ?'.format(table),
+                                    (match,)).fetchone()[0]
+        return ids, total
+
+    def create_index(self, index):
+        with self.lock:
+            self.db.execute('DROP TABLE IF EXISTS {}'.format(self._quote(index)))
+            self.fields.pop(index, None)
+
+    def point_alias(self, alias, index):
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.execute('DROP TABLE IF EXISTS {}'.format(self._quote(alias)))
+            if self._fields(index):
+                self.db.execute('ALTER TABLE {} RENAME TO {}'.format(self._quote(index), self._quote(alias)))
+            self.db.execute('COMMIT')
+            self.fields.clear()
+
+
+BACKENDS = {
+    'elasticsearch': ElasticsearchBackend,
+    'sqlite': SQLiteBackend,
+}
@@ -0,0 +1,223 @@
+import json
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import time
+from flask import current_app
+from app import db, page_cache
+from app.cache import LRUCache
+
+
+class Subscription(object):
+    """One open /stream/timeline connection and the authors it listens to."""
+
+    def __init__(self, broker, user_id, authors, size):
+        self.broker = broker
+        self.user_id = user_id
+        self.authors = frozenset(authors)
+        self.queue = Queue(size)
+        self.dropped = 0
+
+    def put(self, post_id):
+        try:
+            self.queue.put_nowait(post_id)
+        except Full:
+            self.dropped += 1
+
+    def events(self, backlog=(), heartbeat=15, timeout=300):
+        """Server-sent events for new posts, ending after ``timeout`` seconds.
+
+        The browser reconnects by itself and sends the id of the last post it
+        received, which is how posts published in between are caught up.
+        """
+        try:
+            yield 'retry: 3000\n\n'
+            for post_id in backlog:
+                yield self.broker.event(post_id)
+            deadline = time() + timeout
+            while time() < deadline:
+                try:
+                    post_id = self.queue.get(timeout=heartbeat)
+                except Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if post_id is None:
+                    break
+                yield self.broker.event(post_id)
+        finally:
+            self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    """In-process pub/sub of new posts, fanned out to the subscriptions of their author."""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = Lock()
+        self.subscribers = {}
+        self.fragments = LRUCache(256, 60)
+
+    def subscribe(self, user_id, authors):
+        subscription = Subscription(self, user_id, authors, self.app.config['STREAM_QUEUE_SIZE'])
+        with self.lock:
+            for author in subscription.authors:
+                self.subscribers.setdefault(author, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for author in subscription.authors:
+                subscriptions = self.subscribers.get(author)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self.subscribers[author]
+
+    @property
+    def connections(self):
+        with self.lock:
+            return len(set().union(*self.subscribers.values()))
+
+    def publish(self, posts):
+        """Hand ``(post id, author id)`` pairs to the subscriptions of their authors."""
+        self.dispatch(posts)
+
+    def dispatch(self, posts):
+        for post_id, author_id in posts:
+            with self.lock:
+                subscriptions = list(self.subscribers.get(author_id, ()))
+            for subscription in subscriptions:
+                subscription.put(post_id)
+
+    def close(self):
+        with self.lock:
+            subscriptions = set().union(*self.subscribers.values())
+        for subscription in subscriptions:
+            subscription.put(None)
+
+    def event(self, post_id):
+        # rendered once for all the connections it is sent to
+        data = self.fragments.get(post_id)
+        if data is None:
+            from app.models import Post
+            post = Post.query.options(db.joinedload(Post.author)).get(post_id)
+            data = ''.join('data: {}\n'.format(line) for line in page_cache.render_post(post).splitlines()) \
+                if post is not None else ''
+            db.session.remove()
+            self.fragments.set(post_id, data)
+        if not data:
+            return ''
+        return 'id: {}\nevent: post\n{}\n'.format(post_id, data)
+
+
+class RedisBroker(LocalBroker):
+    """Pub/sub through a Redis channel, so posts reach the streams of every process."""
+
+    channel = 'microblog:posts'
+
+    def __init__(self, app):
+        super(RedisBroker, self).__init__(app)
+        import redis
+        self.redis = redis.Redis.from_url(app.config['STREAM_BROKER_URL'])
+        self.listener = None
+
+    def subscribe(self, user_id, authors):
+        if self.listener is None:
+            with self.lock:
+                if self.listener is None:
+                    self.listener = Thread(target=self._listen, name='stream-broker', daemon=True)
+                    self.listener.start()
+        return super(RedisBroker, self).subscribe(user_id, authors)
+
+    def publish(self, posts):
+        self.redis.publish(self.channel, json.dumps(list(posts)))
+
+    def _listen(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            try:
+                self.dispatch(json.loads(message['data']))
+            except Exception as e:
+                self.app.logger.warning('Bad timeline stream message: %s', e)
+
+
+class TimelineStream(object):
+    """Pushes new posts to the open home pages of their author's followers.
+
+    Committed posts are published to a broker, by default in this process
+    only; with STREAM_BROKER_URL set they go through Redis and reach every
+    worker. Each connection waits on its own queue, so a worker run with
+    gevent (``gunicorn -k gevent microblog:app``) holds thousands of them.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        broker = RedisBroker if app.config['STREAM_BROKER_URL'] else LocalBroker
+        app.extensions['timeline_stream'] = broker(app)
+
+    @property
+    def broker(self):
+        return current_app.extensions['timeline_stream']
+
+    def subscribe(self, user):
+        from app.models import followers
+        authors = [row[0] for row in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == user.id)]
+        return self.broker.subscribe(user.id, authors + [user.id])
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        from app.models import Post
+        posts = [(obj.id, obj.user_id) for obj in session.new if isinstance(obj, Post)]
+        if posts:
+            session.info.setdefault('stream_posts', []).extend(posts)
+
+    @staticmethod
+    def after_commit(session):
+        posts = session.info.pop('stream_posts', None)
+        if posts and 'timeline_stream' in current_app.extensions:
+            try:
+                current_app.extensions['timeline_stream'].publish(posts)
+            except Exception as e:
+                current_app.logger.warning('Could not publish new posts: %s', e)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('stream_posts', None)
+
+
+def benchmark(connections, authors=100):
+    """Open idle subscriptions, each served by a thread, and measure the memory they hold."""
+    import resource
+
+    def rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except (IOError, OSError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    broker = LocalBroker(current_app._get_current_object())
+    broker.fragments.set(0, 'data: <p>benchmark</p>\n')
+    before = rss()
+    threads = []
+    for i in range(connections):
+        subscription = broker.subscribe(i, range(i % authors, i % authors + 10))
+        thread = Thread(target=lambda events: sum(1 for _ in events), args=(subscription.events(timeout=3600),),
+                        daemon=True)
+        thread.start()
+        threads.append(thread)
+    held = rss() - before
+    start = time()
+    broker.publish([(0, author) for author in range(authors)])
+    delivered = time() - start
+    broker.close()
+    for thread in threads:
+        thread.join()
+    megabytes = held / 1024.0 / 1024.0
+    return {'connections': connections, 'rss_mb': megabytes,
+            'connections_per_mb': connections / megabytes if megabytes else float('inf'),
+            'publish_seconds': delivered}
@@ -0,0 +1,165 @@
+from time import time
+from flask import current_app
+from sqlalchemy import exists, func, literal, select
+from app import db, jobs
+
+# Materialized home timelines (fan-out-on-write). Every post is copied into the
+# inbox of its author and of the author's followers when it is flushed, so the
+# home page only has to read one indexed slice of this table. Posts from very
+# popular authors are not copied and are merged in at read time instead.
+timeline = db.Table('timeline',
+                    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+                    db.Column('timestamp', db.DateTime, nullable=False),
+                    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp')
+                    )
+
+# The users whose timeline has been built, including the ones that came out
+# empty, so those are not rebuilt on every read.
+timeline_built = db.Table('timeline_built',
+                          db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+                          )
+
+
+def is_enabled():
+    return current_app.config['TIMELINE_ENABLED']
+
+
+def popular_authors(connection=None):
+    """Ids of users with too many followers to fan out to, cached for a while.
+
+    Fan-out on write and the merge on read both go by this set, so a post is
+    always reached by one of them.
+    """
+    from app.models import followers
+    popular = current_app.extensions.setdefault('timeline', {'ids': frozenset(), 'expires': 0})
+    if popular['expires'] < time():
+        rows = (connection or db.session).execute(
+            select([followers.c.followed_id]).group_by(followers.c.followed_id).having(
+                func.count(followers.c.follower_id) >= current_app.config['TIMELINE_FANOUT_LIMIT']))
+        popular['ids'] = frozenset(row[0] for row in rows)
+        popular['expires'] = time() + current_app.config['TIMELINE_POPULAR_TTL']
+    return popular['ids']
+
+
+def _has_timeline(user_id):
+    return exists().where(timeline_built.c.user_id == user_id)
+
+
+def is_built(user):
+    return db.session.query(exists().where(timeline_built.c.user_id == user.id)).scalar()
+
+
+def _trim(connection, owners):
+    t = timeline.alias()
+    cutoff = select([t.c.timestamp]).where(t.c.user_id == timeline.c.user_id).order_by(
+        t.c.timestamp.desc()).limit(1).offset(current_app.config['TIMELINE_LENGTH']).as_scalar()
+    connection.execute(timeline.delete().where(timeline.c.user_id.in_(owners)).where(
+        timeline.c.timestamp <= cutoff))
+
+
+def fan_out(connection, post):
+    """Copy ``post`` into the timelines of its author and followers that have been built.
+
+    Timelines that do not exist yet are left alone; they are rebuilt from
+    followed_posts() when they are first read. Trimming the timelines back to
+    TIMELINE_LENGTH is left to a job, so posting does not wait for it.
+    """
+    from app.models import followers
+    connection.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([literal(post.user_id), literal(post.id), literal(post.timestamp)]).where(
+            _has_timeline(post.user_id))))
+    if post.user_id not in popular_authors(connection):
+        connection.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            select([followers.c.follower_id, literal(post.id), literal(post.timestamp)]).where(
+                followers.c.followed_id == post.user_id).where(_has_timeline(followers.c.follower_id))))
+
+
+def after_flush(session, flush_context):
+    from app.models import Post
+    if not is_enabled():
+        return
+    connection = session.connection()
+    authors = set()
+    for obj in session.new:
+        if isinstance(obj, Post):
+            fan_out(connection, obj)
+            authors.add(obj.user_id)
+    if authors:
+        jobs.enqueue('timeline_trim', {'authors': sorted(authors)})
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+    if deleted:
+        connection.execute(timeline.delete().where(timeline.c.post_id.in_(deleted)))
+
+
+@jobs.handler('timeline_trim')
+def trim_timelines(payloads):
+    """Cut the timelines new posts went to back to the newest TIMELINE_LENGTH entries.
+
+    Only the timelines of the authors and their followers that went over the
+    cap are touched.
+    """
+    from app.models import followers
+    authors = set(author for payload in payloads for author in payload['authors'])
+    with db.engine.begin() as connection:
+        owners = set(authors)
+        fanned = authors - popular_authors(connection)
+        if fanned:
+            owners.update(row[0] for row in connection.execute(
+                select([followers.c.follower_id]).where(followers.c.followed_id.in_(fanned))))
+        over = [row[0] for row in connection.execute(
+            select([timeline.c.user_id]).where(timeline.c.user_id.in_(owners)).group_by(
+                timeline.c.user_id).having(func.count() > current_app.config['TIMELINE_LENGTH']))]
+        if over:
+            _trim(connection, over)
+    return [None] * len(payloads)
+
+
+def follow(user, followed):
+    """Copy the newest posts of a newly followed user into ``user``'s timeline."""
+    from app.models import Post
+    if not is_enabled() or followed.id in popular_authors():
+        return
+    if not is_built(user):
+        return  # rebuilt lazily on the next read
+    recent = select([literal(user.id), Post.id, Post.timestamp]).where(
+        Post.user_id == followed.id).order_by(Post.timestamp.desc()).limit(
+        current_app.config['TIMELINE_LENGTH'])
+    db.session.execute(timeline.insert().from_select(['user_id', 'post_id', 'timestamp'], recent))
+    _trim(db.session, [user.id])
+
+
+def unfollow(user, followed):
+    from app.models import Post
+    if not is_enabled():
+        return
+    db.session.execute(timeline.delete().where(timeline.c.user_id == user.id).where(
+        timeline.c.post_id.in_(select([Post.id]).where(Post.user_id == followed.id))))
+
+
+def rebuild(user):
+    rows = user.followed_posts().limit(current_app.config['TIMELINE_LENGTH']).all()
+    db.session.execute(timeline.delete().where(timeline.c.user_id == user.id))
+    if not is_built(user):
+        db.session.execute(timeline_built.insert().values(user_id=user.id))
+    if rows:
+        db.session.execute(timeline.insert(), [
+            {'user_id': user.id, 'post_id': post.id, 'timestamp': post.timestamp} for post in rows])
+
+
+def home_timeline(user):
+    """The posts shown on ``user``'s home page, newest first."""
+    from app.models import Post, followers
+    if not is_built(user):
+        rebuild(user)
+        db.session.commit()
+    posts = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+        timeline.c.user_id == user.id)
+    popular = popular_authors()
+    if not popular:
+        return posts.order_by(timeline.c.timestamp.desc())
+    pulled = Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(
+        followers.c.follower_id == user.id).filter(Post.user_id.in_(popular))
+    return posts.union(pulled).order_by(Post.timestamp.desc())
@@ -0,0 +1,336 @@
+"""Benchmarks of the hot views on seeded synthetic data.
+
+    python benchmark.py --scale 1 --requests 200 --output bench.json
+    python benchmark.py --compare bench.json
+
+Everything runs offline: the data goes into a throwaway SQLite file and
+search into ``FakeSearchBackend``. Each scenario drives the real app through
+the Flask test client and reports latency percentiles, SQL statements per
+request and the peak RSS reached while it ran. Results are JSON so runs on
+different commits can be compared.
+"""
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import accumulate
+from threading import Lock
+from time import perf_counter, time
+import click
+from app import create_app, db, last_seen, passwords, recommendations
+from app.models import ApprovalNo, ChipId, Post, ProductCategory, User, WorkOrderNo, followers
+from config import Config
+
+PASSWORD = 'benchmark'
+
+
+class FakeSearchBackend(object):
+    """An in-process inverted index, so search is measured without a search server."""
+
+    def __init__(self, app):
+        # ``app`` is part of the search backend interface; this one needs nothing from it
+        self.lock = Lock()
+        self.words = defaultdict(lambda: defaultdict(set))
+
+    def bulk(self, changes):
+        with self.lock:
+            for (index, id), payload in changes:
+                for ids in self.words[index].values():
+                    ids.discard(id)
+                for value in (payload or {}).values():
+                    for word in re.findall(r'\w+', str(value).lower()):
+                        self.words[index][word].add(id)
+        return []
+
+    def query(self, index, query, page, per_page):
+        with self.lock:
+            ids = set().union(*[self.words[index].get(word, ()) for word in re.findall(r'\w+', query.lower())])
+        ids = sorted(ids, reverse=True)
+        return ids[(page - 1) * per_page:page * per_page], len(ids)
+
+    def create_index(self, index):
+        with self.lock:
+            self.words.pop(index, None)
+
+    def point_alias(self, alias, index):
+        with self.lock:
+            self.words[alias] = self.words.pop(index, defaultdict(set))
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SEARCH_BACKEND = 'benchmark:FakeSearchBackend'
+    SEARCH_INDEX_ASYNC = False
+    JOBS_ASYNC = False
+    MAIL_TRANSPORT = 'fake'
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+
+def zipf_weights(n, s=1.0):
+    """Cumulative weights of range(n) where i has weight 1 / (i + 1) ** s."""
+    return list(accumulate(1.0 / (i + 1) ** s for i in range(n)))
+
+
+def zipf(n, rng, k, s=1.0, cum_weights=None):
+    """``k`` picks from range(n) where i is picked with weight 1 / (i + 1) ** s.
+
+    Pass ``cum_weights`` from zipf_weights when picking from the same range
+    repeatedly; building them is O(n).
+    """
+    return rng.choices(range(n), cum_weights=cum_weights or zipf_weights(n, s), k=k)
+
+
+def vocabulary(rng, size):
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'po', 'da', 'gu']
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(syllables) for i in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def generate(scale=1.0, seed=0, follows=20, posts_per_user=10, chips_per_order=100, chunk_size=5000):
+    """Fill the database with a seeded synthetic data set; returns its row counts.
+
+    ``scale`` 1 is 1000 users following 1 to ``2 * follows`` accounts picked
+    by a power law, ``posts_per_user`` posts each on average over 90 days
+    from authors picked by a power law too, and 200 work orders of about
+    ``chips_per_order`` chips over 50 approvals and 8 categories.
+    """
+    rng = random.Random(seed)
+    users = max(10, int(1000 * scale))
+    now = datetime.utcnow()
+
+    def insert(table, rows):
+        rows = iter(rows)
+        while True:
+            chunk = [row for row, i in zip(rows, range(chunk_size))]
+            if not chunk:
+                break
+            db.session.execute(table.insert(), chunk)
+
+    pwhash = passwords.hash(PASSWORD)
+    insert(User.__table__, ({'id': i + 1, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+                             'password_hash': pwhash, 'about_me': 'Benchmark user {}'.format(i),
+                             'last_seen': now - timedelta(minutes=rng.randint(0, 60 * 24 * 30))}
+                            for i in range(users)))
+    edges = 0
+    with_edges = []
+    for follower, followed in recommendations.synthetic_graph(users, follows, seed):
+        with_edges.append({'follower_id': follower + 1, 'followed_id': followed + 1})
+        if len(with_edges) == chunk_size:
+            insert(followers, with_edges)
+            edges += len(with_edges)
+            with_edges = []
+    insert(followers, with_edges)
+    edges += len(with_edges)
+
+    words = vocabulary(rng, 2000)
+    total = users * posts_per_user
+    authors = zipf(users, rng, total, 0.8)
+    moments = sorted(now - timedelta(seconds=rng.uniform(0, 90 * 24 * 3600)) for i in range(total))
+    insert(Post.__table__, ({'id': i + 1, 'user_id': author + 1, 'timestamp': moment,
+                             'body': ' '.join(words[w] for w in zipf(len(words), rng, rng.randint(3, 20)))[:140]}
+                            for i, (author, moment) in enumerate(zip(authors, moments))))
+
+    orders = max(4, int(200 * scale))
+    approvals = max(2, orders // 4)
+    categories = 8
+    insert(ProductCategory.__table__, ({'id': i + 1, 'product_category': 'CATEGORY{}'.format(i)}
+                                       for i in range(categories)))
+    insert(ApprovalNo.__table__, ({'id': i + 1, 'approval_no': 'AP{:08d}'.format(i)} for i in range(approvals)))
+    insert(WorkOrderNo.__table__, ({'id': i + 1, 'work_order_no': 'WO{:011d}'.format(i)} for i in range(orders)))
+    chips = orders * chips_per_order
+    per_order = zipf(orders, rng, chips, 0.5)
+    category_weights = zipf_weights(categories)
+    insert(ChipId.__table__, ({'id': i + 1, 'chip_id': 'CHIP{:012d}'.format(i), 'asset_no': 'AS{:012d}'.format(i),
+                               'work_order_no_id': order + 1, 'approval_no_id': order % approvals + 1,
+                               'product_category_id': zipf(categories, rng, 1, cum_weights=category_weights)[0] + 1}
+                              for i, order in enumerate(per_order)))
+    db.session.commit()
+
+    User.reconcile_counts()
+    recommendations.rebuild()
+    Post.reindex()
+    return {'users': users, 'follows': edges, 'posts': total, 'work_orders': orders, 'approvals': approvals,
+            'categories': categories, 'chips': chips, 'words': words}
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            return int(re.search(r'VmHWM:\s+(\d+)', f.read()).group(1)) / 1024.0
+    except (IOError, OSError, AttributeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def reset_peak_rss():
+    """Start a new peak RSS measurement where the kernel allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def scenarios(app, data, seed=0):
+    """``{name: next_request}`` where each call returns the next ``(client, url)`` to get."""
+    rng = random.Random(seed)
+    users = data['users']
+    with app.app_context():
+        busiest = [row[0] for row in db.session.query(User.username).order_by(User.followed_count.desc()).limit(5)]
+    sampled = busiest + ['user{}'.format(i) for i in rng.sample(range(users), min(5, users))]
+    clients = []
+    for username in sampled:
+        client = app.test_client()
+        client.post('/auth/login', data={'username': username, 'password': PASSWORD})
+        clients.append(client)
+    categories = ['CATEGORY{}'.format(i) for i in range(data['categories'])]
+
+    # built once, not in the measured loop
+    user_weights = zipf_weights(users)
+    word_weights = zipf_weights(len(data['words']))
+
+    def pick():
+        return rng.choice(clients)
+
+    def chips(method, value):
+        query = '&'.join('product_category={}'.format(c) for c in rng.sample(categories, rng.randint(1, 4)))
+        return '/chipid_results?method_query={}&field_query={}&{}'.format(method, value, query)
+
+    return {
+        'index': lambda: (pick(), '/index'),
+        'explore': lambda: (pick(), '/explore'),
+        'user': lambda: (pick(), '/user/user{}'.format(zipf(users, rng, 1, cum_weights=user_weights)[0])),
+        'search': lambda: (pick(), '/search?q={}'.format(
+            data['words'][zipf(len(data['words']), rng, 1, cum_weights=word_weights)[0]])),
+        'chipid_results_work_order': lambda: (
+            pick(), chips(2, 'WO{:011d}'.format(rng.randrange(data['work_orders'])))),
+        'chipid_results_approval': lambda: (pick(), chips(1, 'AP{:08d}'.format(rng.randrange(data['approvals'])))),
+        'chipid_results_csv': lambda: (
+            pick(), chips(2, 'WO{:011d}'.format(rng.randrange(data['work_orders']))) + '&format=csv'),
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def measure(app, next_request, requests, warmup):
+    statements = []
+
+    def count(*args):
+        statements.append(None)
+
+    with app.app_context():
+        engine = db.engine
+    for i in range(warmup):
+        client, url = next_request()
+        client.get(url).get_data()
+    latencies, queries, errors = [], [], 0
+    reset_peak_rss()
+    db.event.listen(engine, 'before_cursor_execute', count)
+    try:
+        for i in range(requests):
+            client, url = next_request()
+            del statements[:]
+            start = perf_counter()
+            response = client.get(url)
+            response.get_data()
+            latencies.append((perf_counter() - start) * 1000)
+            queries.append(len(statements))
+            if response.status_code >= 400:
+                errors += 1
+    finally:
+        db.event.remove(engine, 'before_cursor_execute', count)
+    return {'requests': requests, 'errors': errors,
+            'p50_ms': percentile(latencies, 50), 'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99), 'mean_ms': sum(latencies) / len(latencies),
+            'queries_per_request': sum(queries) / float(len(queries)), 'max_queries': max(queries),
+            'peak_rss_mb': rss_mb()}
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scale=1.0, seed=0, requests=200, warmup=20, only=None, config_class=BenchmarkConfig):
+    """Seed a fresh database and run the scenarios; returns the results as a dict."""
+    directory = tempfile.mkdtemp(prefix='microblog-benchmark-')
+    try:
+        config = type('Config', (config_class,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'app.db')})
+        app = create_app(config)
+        with app.app_context():
+            db.create_all()
+            start = time()
+            data = generate(scale, seed)
+            seconds = time() - start
+        results = {}
+        for name, next_request in scenarios(app, data, seed).items():
+            if not only or name in only:
+                results[name] = measure(app, next_request, requests, warmup)
+        with app.app_context():
+            last_seen.flush()
+            db.session.remove()
+            db.engine.dispose()
+        data.pop('words')
+        return {'commit': commit(), 'time': datetime.utcnow().isoformat() + 'Z', 'python': platform.python_version(),
+                'platform': platform.platform(), 'scale': scale, 'seed': seed, 'data': data,
+                'seed_seconds': seconds, 'scenarios': results}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def compare(old, new):
+    """Lines showing how each scenario of ``new`` moved against ``old``."""
+    lines = []
+    for name, result in new['scenarios'].items():
+        before = old['scenarios'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request', 'peak_rss_mb'):
+            change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            changes.append('{} {:.1f} -> {:.1f} ({:+.0f}%)'.format(key, before[key], result[key], change))
+        lines.append('{}: {}'.format(name, ', '.join(changes)))
+    return lines
+
+
+@click.command()
+@click.option('--scale', default=1.0, show_default=True, help='1 is 1000 users, 10000 posts and 20000 chips.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--requests', default=200, show_default=True, help='Measured requests per scenario.')
+@click.option('--warmup', default=20, show_default=True, help='Unmeasured requests per scenario.')
+@click.option('--scenario', 'only', multiple=True, help='Run only these scenarios.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results to this JSON file.')
+@click.option('--compare', 'baseline', type=click.File(), help='Results of an earlier run to compare with.')
+def main(scale, seed, requests, warmup, only, output, baseline):
+    """Benchmark the hot views on synthetic data."""
+    results = run(scale, seed, requests, warmup, only)
+    for name, result in results['scenarios'].items():
+        click.echo('{:28} p50 {p50_ms:7.1f}ms  p95 {p95_ms:7.1f}ms  p99 {p99_ms:7.1f}ms  '
+                   '{queries_per_request:5.1f} queries  {peak_rss_mb:6.0f} MB  {errors} errors'.format(
+                       name, **result))
+    if baseline is not None:
+        for line in compare(json.load(baseline), results):
+            click.echo(line)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,14 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if uri]
+    SQLALCHEMY_REPLICA_LAG = int(os.environ.get('DATABASE_REPLICA_LAG') or 5)
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_POOL_TIMEOUT = 10
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)
+    DATABASE_POOL_PRE_PING = True
+    SQLITE_BUSY_TIMEOUT = 5000
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_SSL = True if 'true' == os.environ.get('MAIL_USE_SSL') else False
@@ -14,5 +22,73 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['noreply@heypython.cn']
+    LOG_TO_STDOUT = True if 'true' == os.environ.get('LOG_TO_STDOUT') else False
+    LOG_FILE = os.environ.get('LOG_FILE') or 'logs/microblog.log'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 50 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_QUEUE_SIZE = 10000
+    LOG_MAIL_WINDOW = int(os.environ.get('LOG_MAIL_WINDOW') or 600)
+    LOG_MAIL_LIMIT = int(os.environ.get('LOG_MAIL_LIMIT') or 10)
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = 8
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 0)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 0)
+    SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY')
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT') or 'sendgrid'
+    MAIL_SEND_TIMEOUT = 10
+    JOBS_ASYNC = False if 'false' == os.environ.get('JOBS_ASYNC') else True
+    JOBS_IN_APP = False if 'false' == os.environ.get('JOBS_IN_APP') else True
+    JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS') or 2)
+    JOBS_BATCH_SIZE = 50
+    JOBS_MAX_ATTEMPTS = 6
+    JOBS_RETRY_BACKOFF = 5
+    JOBS_POLL_INTERVAL = 5
+    JOBS_CLAIM_TIMEOUT = 600
     POSTS_PER_PAGE = 10
+    CHIPID_IMPORT_BATCH_SIZE = int(os.environ.get('CHIPID_IMPORT_BATCH_SIZE') or 5000)
+    CHIPID_LOOKUP_MAX = 100000
+    CHIPID_CACHE_SIZE = 1024
+    CHIPID_CACHE_TTL = int(os.environ.get('CHIPID_CACHE_TTL') or 300)
+    CHIPID_CACHE_URL = os.environ.get('CHIPID_CACHE_URL')
+    CHIPID_MATCH_LIMIT = 20
+    CHIPID_NUMBER_CHECK_INTERVAL = 1.0
+    CHIPID_VERSION_CHECK_INTERVAL = float(os.environ.get('CHIPID_VERSION_CHECK_INTERVAL') or 1.0)
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_SQLITE_PATH = os.environ.get('SEARCH_SQLITE_PATH') or os.path.join(basedir, 'search.db')
+    TIMELINE_ENABLED = True if 'true' == os.environ.get('TIMELINE_ENABLED') else False
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
+    TIMELINE_POPULAR_TTL = 300
+    RECOMMENDATIONS_TOP_K = 10
+    RECOMMENDATIONS_SHOWN = 5
+    RECOMMENDATIONS_MAX_FANOUT = 1000
+    POST_FRAGMENT_CACHE_SIZE = 10000
+    POST_FRAGMENT_CACHE_TTL = 3600
+    EXPLORE_CACHE_SIZE = 64
+    EXPLORE_CACHE_TTL = 10
+    STREAM_BROKER_URL = os.environ.get('STREAM_BROKER_URL')
+    STREAM_QUEUE_SIZE = 100
+    STREAM_HEARTBEAT = 15
+    STREAM_TIMEOUT = 300
+    STREAM_BACKLOG = 50
+    METRICS_ENABLED = False if 'false' == os.environ.get('METRICS_ENABLED') else True
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_LOG = True if 'true' == os.environ.get('METRICS_LOG') else False
+    METRICS_SLOW_QUERY = float(os.environ.get('METRICS_SLOW_QUERY') or 0.25)
+    METRICS_SLOW_QUERY_SAMPLES = 50
+    PAGINATION_COUNT_TTL = 60
+    PAGINATION_COUNT_CACHE_SIZE = 1024
+    LAST_SEEN_THRESHOLD = 60
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+    LAST_SEEN_FLUSH_COUNT = int(os.environ.get('LAST_SEEN_FLUSH_COUNT') or 100)
+    SEARCH_INDEX_ASYNC = False if 'false' == os.environ.get('SEARCH_INDEX_ASYNC') else True
+    SEARCH_INDEX_BATCH_SIZE = 500
+    SEARCH_INDEX_FLUSH_INTERVAL = 1.0
+    SEARCH_INDEX_MAX_RETRIES = 5
+    SEARCH_INDEX_RETRY_BACKOFF = 0.5
+    SEARCH_REBUILD_CHECK_INTERVAL = 1.0
+    ASSETS_BUILD_DIR = os.environ.get('ASSETS_BUILD_DIR') or os.path.join(basedir, 'build', 'static')
+    ASSETS_MAX_AGE = 365 * 24 * 3600
+    ASSETS_INCLUDE = []
+    ASSETS_COMPRESS_MIN_SIZE = 512
@@ -1,17 +1,143 @@
 from datetime import datetime, timedelta
+import base64
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
 import unittest
-from app import app, db
-from app.models import User, Post
+from time import time
+import benchmark
+from flask import url_for
+from sqlalchemy.exc import IntegrityError
+from app import assets, chip_cache, create_app, db, jobs, last_seen, page_cache, recommendations, search_indexer, \
+    timeline
+from app.assets import build
+from app.auth.email import SendGridTransport, transport
+from app.jobs import PermanentError, job
+from app.log import ThrottledSMTPHandler, init_logging
+from app.passwords import HashingBusy
+from app.chip_cache import chipid_versions
+from app.chip_import import ChipImporter, read_csv
+from app.indexer import Reindexer, search_backlog, search_changes
+from app.search_backends import ElasticsearchBackend, elasticsearch_client
+from app.pagination import decode_cursor, encode_cursor, paginate
+from app.models import User, Post, ChipId, WorkOrderNo, ApprovalNo, ProductCategory, followers
+from config import Config
+
+# how many times as long as `import flask` the rest of `import app` may take,
+# as reported by python -X importtime; about 3 when measured, so an extra
+# heavy dependency imported up front shows
+IMPORT_TIME_BUDGET = 4.0
+
+
+class TestConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SEARCH_SQLITE_PATH = ':memory:'
+    SEARCH_INDEX_ASYNC = False
+    JOBS_ASYNC = False
+    MAIL_TRANSPORT = 'fake'
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    SEARCH_REBUILD_CHECK_INTERVAL = 0
+
+
+class FakeIndices(object):
+    def __init__(self, es):
+        self.es = es
+
+    def create(self, index):
+        self.es.indices_created.add(index)
+
+    def exists(self, index):
+        return index in self.es.indices_created or any(key[0] == index for key in self.es.documents)
+
+    def exists_alias(self, name):
+        return name in self.es.aliases
+
+    def get_alias(self, name):
+        return {self.es.aliases[name]: {'aliases': {name: {}}}}
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            op, args = list(action.items())[0]
+            if op == 'add':
+                self.es.aliases[args['alias']] = args['index']
+            elif op == 'remove_index':
+                self.delete(args['index'])
+
+    def delete(self, index):
+        self.es.indices_created.discard(index)
+        for key in [key for key in self.es.documents if key[0] == index]:
+            del self.es.documents[key]
+
+
+class FakeElasticsearch(object):
+    def __init__(self):
+        self.documents = {}
+        self.indices_created = set()
+        self.aliases = {}
+        self.indices = FakeIndices(self)
+        self.bulk_requests = 0
+        self.down = False
+        self.outages = 0
+        self.rejected = set()
+
+    def bulk(self, body):
+        if self.down or self.outages:
+            self.outages = max(self.outages - 1, 0)
+            raise ConnectionError('cluster is down')
+        self.bulk_requests += 1
+        actions = iter(body)
+        items = []
+        for action in actions:
+            op, meta = list(action.items())[0]
+            key = (self.aliases.get(meta['_index'], meta['_index']), meta['_id'])
+            document = next(actions) if op == 'index' else None
+            status = 429 if meta['_id'] in self.rejected else 200
+            if status == 200 and op == 'index':
+                self.documents[key] = document
+            elif status == 200:
+                self.documents.pop(key, None)
+            items.append({op: {'_index': key[0], '_id': str(meta['_id']), 'status': status}})
+        return {'errors': any(list(item.values())[0]['status'] != 200 for item in items), 'items': items}
+
+
+class FakeSharedCache(object):
+    ttl = 60
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.values[key] = value
 
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
         db.create_all()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        self.app_context.pop()
+
+    def use_fake_elasticsearch(self):
+        self.app.elasticsearch = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend(self.app)
+        return self.app.elasticsearch
 
     def test_password_hasing(self):
         u = User(username='susan')
@@ -19,6 +145,28 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        u = User(username='susan')
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:500'
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:500$'))
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:500$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_pool_busy(self):
+        self.app.config['PASSWORD_HASH_QUEUE'] = 1
+        u = User(username='susan')
+        u.set_password('cat')
+        slots = self.app.extensions['passwords']['slots']
+        slots.acquire()
+        self.assertRaises(HashingBusy, u.check_password, 'cat')
+        slots.release()
+        self.assertTrue(u.check_password('cat'))
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
@@ -34,9 +182,12 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.all(), [])
         self.assertEqual(u1.followers.all(), [])
 
+        u1.follow(u2)
         u1.follow(u2)
         db.session.commit()
         self.assertTrue(u1.is_following(u2))
+        self.assertFalse(u2.is_following(u1))
+        self.assertEqual((u1.followed_count, u1.followers_count, u2.followers_count), (1, 0, 1))
         self.assertEqual(u1.followed.count(), 1)
         self.assertEqual(u1.followed.first().username, 'susan')
         self.assertEqual(u2.followers.count(), 1)
@@ -47,6 +198,48 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u1.is_following(u2))
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
+        self.assertEqual((u1.followed_count, u2.followers_count), (0, 0))
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2, Post(body='one', author=u1), Post(body='two', author=u1)])
+        db.session.commit()
+        self.assertEqual((u1.posts_count, u2.posts_count), (2, 0))
+        db.session.add(Post(body='three', user_id=u2.id))
+        db.session.delete(u1.posts.first())
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual((u1.posts_count, u2.posts_count, u1.followers_count), (1, 1, 1))
+
+        # drift is repaired by the reconciliation
+        db.session.execute(User.__table__.update().values(posts_count=7, followers_count=0))
+        db.session.commit()
+        self.assertEqual(User.reconcile_counts(), 2)
+        self.assertEqual((u1.posts_count, u2.posts_count, u1.followers_count), (1, 1, 1))
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_unique_follows(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        with self.assertRaises(IntegrityError):
+            db.session.execute(followers.insert().values(follower_id=u1.id, followed_id=u2.id))
+        db.session.rollback()
+
+        # a database from before the constraint is cleaned up so that it can be added
+        ids = u1.id, u2.id
+        db.session.execute('DROP TABLE followers')
+        db.session.execute('CREATE TABLE followers (follower_id INTEGER, followed_id INTEGER)')
+        db.session.execute(followers.insert(), [{'follower_id': ids[0], 'followed_id': ids[1]}] * 3 +
+                           [{'follower_id': ids[1], 'followed_id': ids[0]}])
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['users', 'dedupe-follows'])
+        self.assertIn('Removed 2 duplicate follows', result.output)
+        self.assertEqual(sorted(db.session.query(followers).all()), sorted([(ids[0], ids[1]), (ids[1], ids[0])]))
 
     def test_follow_posts(self):
         u1 = User(username='john', email='john@example.com')
@@ -85,6 +278,1014 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_home_timeline(self):
+        self.app.config['TIMELINE_ENABLED'] = True
+        self.app.config['TIMELINE_LENGTH'] = 3
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # posts are fanned out to followers when they are written
+        now = datetime.utcnow()
+        p1 = Post(body='post from john', author=u1, timestamp=now + timedelta(seconds=1))
+        p2 = Post(body='post from susan', author=u2, timestamp=now + timedelta(seconds=2))
+        p3 = Post(body='post from mary', author=u3, timestamp=now + timedelta(seconds=3))
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        self.assertEqual(u1.home_timeline().all(), [p2, p1])
+        self.assertEqual(u1.home_timeline().all(), u1.followed_posts().all())
+
+        # following backfills, unfollowing removes
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.home_timeline().all(), [p3, p2, p1])
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.home_timeline().all(), [p3, p1])
+
+        # timelines are capped to the newest TIMELINE_LENGTH entries
+        p4 = Post(body='another post from mary', author=u3, timestamp=now + timedelta(seconds=4))
+        p5 = Post(body='yet another post from mary', author=u3, timestamp=now + timedelta(seconds=5))
+        db.session.add_all([p4, p5])
+        db.session.commit()
+        self.assertEqual(u1.home_timeline().all(), [p5, p4, p3])
+
+        # an empty timeline is rebuilt from followed_posts()
+        u2.follow(u3)
+        db.session.commit()
+        self.assertEqual(u2.home_timeline().all(), [p5, p4, p3])
+
+    def test_home_timeline_popular_author(self):
+        self.app.config['TIMELINE_ENABLED'] = True
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 2
+        self.app.config['TIMELINE_POPULAR_TTL'] = 0
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        now = datetime.utcnow()
+        p1 = Post(body='post from john', author=u1, timestamp=now + timedelta(seconds=1))
+        db.session.add_all([u1, u2, u3, p1])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.home_timeline().all(), [p1])
+
+        # mary is too popular to fan out to, her posts are pulled on read
+        p2 = Post(body='post from mary', author=u3, timestamp=now + timedelta(seconds=2))
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(db.session.query(timeline.timeline).filter_by(post_id=p2.id, user_id=u1.id).count(), 0)
+        self.assertEqual(u1.home_timeline().all(), [p2, p1])
+        self.assertEqual(u3.home_timeline().all(), [p2])
+
+    def test_home_timeline_not_built(self):
+        self.app.config['TIMELINE_ENABLED'] = True
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        p1 = Post(body='old post from susan', author=u2, timestamp=now + timedelta(seconds=1))
+        db.session.add_all([u1, u2, p1])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # a post reaching a timeline that was never read does not hide the older ones
+        p2 = Post(body='new post from susan', author=u2, timestamp=now + timedelta(seconds=2))
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(db.session.query(timeline.timeline).filter_by(user_id=u1.id).count(), 0)
+        self.assertEqual(u1.home_timeline().all(), [p2, p1])
+        p3 = Post(body='newest post from susan', author=u2, timestamp=now + timedelta(seconds=3))
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(u1.home_timeline().all(), [p3, p2, p1])
+
+        # a timeline that was built empty is not rebuilt on every read, but still gets new posts
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add(u3)
+        db.session.commit()
+        self.assertEqual(u3.home_timeline().all(), [])
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(u3.home_timeline().all(), [])
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertFalse([s for s in statements if not s.lstrip().upper().startswith('SELECT')])
+        u3.follow(u2)
+        p4 = Post(body='post from susan to mary', author=u2, timestamp=now + timedelta(seconds=4))
+        db.session.add(p4)
+        db.session.commit()
+        self.assertEqual(u3.home_timeline().all()[0], p4)
+
+    def test_recommendations(self):
+        john, susan, mary, david = users = [User(username=name, email='{}@example.com'.format(name))
+                                            for name in ('john', 'susan', 'mary', 'david')]
+        db.session.add_all(users)
+        db.session.commit()
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(david)
+        mary.follow(david)
+        mary.follow(john)
+        susan.follow(mary)
+        db.session.commit()
+        self.assertEqual(recommendations.rebuild(top_k=2), 3)
+        self.assertEqual(john.recommended(5), [david])
+        self.assertEqual(susan.recommended(5), [john])
+        self.assertEqual(mary.recommended(5), [susan])
+        john.follow(david)
+        db.session.commit()
+        self.assertEqual(john.recommended(5), [])
+
+        result = recommendations.benchmark(200, 5)
+        self.assertGreater(result['edges'], 0)
+        self.assertGreater(result['rows'], 0)
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u1 if i % 2 else u2,
+                      timestamp=now + timedelta(seconds=i // 2)) for i in range(25)]
+        db.session.add_all([u1, u2] + posts)
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        expected = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+
+        # walk forward with cursors, then back again
+        url, pages = '/explore', []
+        while url:
+            with self.app.test_request_context(url):
+                page = paginate(u1.followed_posts(), [Post.timestamp, Post.id], per_page=10)
+                pages.append(page)
+                url, prev_url = page.next_url, page.prev_url
+        self.assertEqual([len(page.items) for page in pages], [10, 10, 5])
+        self.assertEqual(sum([page.items for page in pages], []), expected)
+        self.assertFalse(pages[0].has_prev)
+        with self.app.test_request_context(prev_url):
+            page = paginate(u1.followed_posts(), [Post.timestamp, Post.id], per_page=10)
+            self.assertEqual(page.items, pages[1].items)
+            self.assertTrue(page.has_next)
+            self.assertTrue(page.has_prev)
+
+        # page numbers still work and bad cursors fall back to the first page
+        with self.app.test_request_context('/explore?page=2'):
+            self.assertEqual(paginate(Post.query, [Post.timestamp, Post.id], per_page=10).items,
+                             pages[1].items)
+        with self.app.test_request_context('/explore?cursor=garbage'):
+            page = paginate(Post.query, [Post.id], per_page=10, descending=False, count=True)
+            self.assertEqual(page.items, sorted(expected, key=lambda p: p.id)[:10])
+            self.assertEqual(page.total, 25)
+        for payload in ({}, [], ['n'], ['n', [1], 2], ['n', {'a': 1}, 2], ['x', 1, 2], ['n', True, 2], 'n',
+                        ['n', '2020-01-01T00:00:00', 'x'], ['n', '2020-01-01T00:00:00', 2.5], ['n', 1, 2]):
+            cursor = base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii').rstrip('=')
+            self.assertIsNone(decode_cursor(cursor, [Post.timestamp, Post.id]), payload)
+        self.assertEqual(decode_cursor(encode_cursor('p', [5, 'x']), [Post.id, Post.body]), ('p', [5, 'x']))
+        self.assertIsNone(decode_cursor(encode_cursor('p', ['x', 5]), [Post.id, Post.body]))
+        with self.app.test_request_context('/explore?cursor=e30'):
+            self.assertEqual(paginate(Post.query, [Post.id], per_page=10, descending=False).items,
+                             sorted(expected, key=lambda p: p.id)[:10])
+
+    def test_search_indexing(self):
+        self.use_fake_elasticsearch()
+        self.app.config['SEARCH_INDEX_RETRY_BACKOFF'] = 0
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=u)
+        p2 = Post(body='second', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.flush()
+        p1.body = 'first, edited'
+        db.session.commit()
+
+        # one bulk request per commit, with the latest version of each post
+        self.assertEqual(self.app.elasticsearch.bulk_requests, 1)
+        self.assertEqual(self.app.elasticsearch.documents, {
+            ('post', p1.id): {'body': 'first, edited'}, ('post', p2.id): {'body': 'second'}})
+
+        # changes made while the cluster is down are kept and replayed
+        self.app.elasticsearch.down = True
+        self.app.config['SEARCH_INDEX_RETRY_BACKOFF'] = 60
+        db.session.delete(p2)
+        p3 = Post(body='third', author=u)
+        db.session.add(p3)
+        start = time()
+        db.session.commit()
+        # without a background thread the commit does not wait for retries
+        self.assertLess(time() - start, 5)
+        self.assertEqual(db.session.query(search_backlog).count(), 2)
+        self.app.elasticsearch.down = False
+        # a newer version sent once the cluster is back is not undone by the parked one
+        p3.body = 'third, edited'
+        db.session.commit()
+        search_indexer.flush()
+        self.assertEqual(db.session.query(search_backlog).count(), 0)
+        self.assertEqual(self.app.elasticsearch.documents, {
+            ('post', p1.id): {'body': 'first, edited'}, ('post', p3.id): {'body': 'third, edited'}})
+
+        # rolled back changes are never sent
+        db.session.add(Post(body='fourth', author=u))
+        db.session.flush()
+        db.session.rollback()
+        search_indexer.flush()
+        self.assertEqual(len(self.app.elasticsearch.documents), 2)
+
+    def test_search_indexing_async(self):
+        self.use_fake_elasticsearch()
+        self.app.config['SEARCH_INDEX_ASYNC'] = True
+        self.app.config['SEARCH_INDEX_FLUSH_INTERVAL'] = 0.01
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Post(body='post {}'.format(i), author=u) for i in range(20)])
+        db.session.commit()
+        self.app.extensions['search_indexer'].stop()
+        self.assertEqual(len(self.app.elasticsearch.documents), 20)
+
+    def test_reindex(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Post(body='post {}'.format(i), author=u) for i in range(10)])
+        db.session.commit()
+        es = self.use_fake_elasticsearch()
+        checkpoints = []
+        reindexer = Reindexer(Post, chunk_size=3, workers=2, after=4)
+        self.assertEqual(reindexer.run(progress=lambda checkpoint, count, elapsed: checkpoints.append(
+            checkpoint)), 6)
+        self.assertEqual(checkpoints, [7, 10])
+        self.assertEqual(es.bulk_requests, 2)
+        self.assertEqual(sorted(es.documents), [('post', i) for i in range(5, 11)])
+
+        # build a fresh index from the command line and swap it in
+        result = self.app.test_cli_runner().invoke(args=['search', 'reindex', '--swap', '--chunk-size', '4'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Indexed 10 posts', result.output)
+        new_index = es.aliases['post']
+        self.assertEqual(sorted(es.documents), [(new_index, i) for i in range(1, 11)])
+
+        # failures are reported under the alias the changes were sent to
+        es.rejected = {3}
+        self.assertEqual(self.app.search_backend.bulk([(('post', 3), {'body': 'x'}), (('post', 4), None)]),
+                         [('post', 3)])
+        es.rejected = set()
+
+        # a request that fails outright is retried, and the last attempt is not followed by a wait
+        self.app.config['SEARCH_INDEX_RETRY_BACKOFF'] = 0
+        es.outages = 1
+        self.assertEqual(Reindexer(Post, chunk_size=20).run(), 10)
+        self.app.config['SEARCH_INDEX_MAX_RETRIES'] = 0
+        self.app.config['SEARCH_INDEX_RETRY_BACKOFF'] = 60
+        es.down = True
+        start = time()
+        with self.assertRaises(RuntimeError):
+            Reindexer(Post, chunk_size=20).run()
+        self.assertLess(time() - start, 5)
+        es.down = False
+
+        # rows changed after the copy passed them reach the new index
+        posts = Post.query.order_by(Post.id).all()
+
+        def change(checkpoint, count, elapsed):
+            if checkpoint == 4:
+                posts[0].body = 'edited during the rebuild'
+                db.session.delete(posts[1])
+                db.session.commit()
+
+        es.indices.create('post-2')
+        Reindexer(Post, chunk_size=4).rebuild('post-2', change)
+        self.assertEqual(es.aliases['post'], 'post-2')
+        self.assertEqual(es.documents[('post-2', 1)], {'body': 'edited during the rebuild'})
+        self.assertNotIn(('post-2', 2), es.documents)
+        self.assertEqual(len([key for key in es.documents if key[0] == 'post-2']), 9)
+        self.assertEqual(db.session.query(search_changes).count(), 0)
+
+    def test_local_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a lazy brown dog', author=u)
+        p3 = Post(body='quick quick fox, the fox', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('fox quick', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(posts.all(), [p3, p1])
+        posts, total = Post.search('brown', 2, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(len(posts.all()), 1)
+
+        # deletes reach the index, and a rebuild is swapped in under the alias
+        db.session.delete(p3)
+        db.session.commit()
+        self.assertEqual(Post.search('fox', 1, 10)[0].all(), [p1])
+        result = self.app.test_cli_runner().invoke(args=['search', 'reindex', '--swap'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(Post.search('brown', 1, 10)[1], 2)
+        self.assertEqual(Post.search('"(*', 1, 10)[1], 0)
+
+
+class ChipIdCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_import(self):
+        csv = io.StringIO('芯片ID,资产码,派工单号,审批单号,产品型态\n' + ''.join(
+            'C{0:04},A{0:04},wo{1},AP{2},cat{3}\n'.format(i, i % 3, i % 2, i % 4) for i in range(10)))
+        importer = ChipImporter(batch_size=4).run(read_csv(csv))
+        self.assertEqual((importer.rows, importer.inserted, importer.updated, importer.skipped), (10, 10, 0, 0))
+        self.assertEqual(WorkOrderNo.query.count(), 3)
+        self.assertEqual(ApprovalNo.query.count(), 2)
+        self.assertEqual(ProductCategory.query.count(), 4)
+        chip = ChipId.query.filter_by(chip_id='C0005').first()
+        self.assertEqual((chip.asset_no, chip.workorderno.work_order_no, chip.approvalno.approval_no,
+                          chip.productcategory.product_category), ('A0005', 'WO2', 'AP1', 'cat1'))
+
+        # existing chips are updated, stolen asset numbers and bad rows reported
+        csv = io.StringIO('chip_id,asset_no,work_order_no,approval_no,product_category\n'
+                          'C0005,A0005,WO9,AP1,cat1\n'
+                          'C0100,A0001,WO9,AP1,cat1\n'
+                          'C0101,,WO9,AP1,cat1\n'
+                          'C0102,A0102,WO9,AP1,cat1\n')
+        importer = ChipImporter().run(read_csv(csv))
+        self.assertEqual((importer.rows, importer.inserted, importer.updated, importer.skipped), (4, 1, 1, 2))
+        self.assertEqual([line for line, message in importer.problems], [4, 3])
+        self.assertEqual(ChipId.query.filter_by(chip_id='C0005').first().workorderno.work_order_no, 'WO9')
+        self.assertEqual(ChipId.query.count(), 11)
+
+        # a chip repeated within a batch counts the same as one repeated across batches
+        csv = ('chip_id,asset_no,work_order_no,approval_no,product_category\n'
+               'C0200,A0200,WO1,AP1,cat1\nC0201,A0201,WO1,AP1,cat1\nC0200,A0200,WO2,AP1,cat1\n')
+        for batch_size, update, counts in ((5000, True, (3, 2, 1, 0)), (1, True, (3, 0, 3, 0)),
+                                           (5000, False, (3, 0, 0, 3)), (1, False, (3, 0, 0, 3))):
+            importer = ChipImporter(batch_size=batch_size, update=update).run(read_csv(io.StringIO(csv)))
+            self.assertEqual((importer.rows, importer.inserted, importer.updated, importer.skipped), counts)
+        self.assertEqual(ChipId.query.filter_by(chip_id='C0200').first().workorderno.work_order_no, 'WO2')
+        importer = ChipImporter(update=False).run(read_csv(io.StringIO(csv.replace('0200', '0300'))))
+        self.assertEqual((importer.rows, importer.inserted, importer.updated, importer.skipped), (3, 1, 0, 2))
+        self.assertEqual(importer.problems[-1], (4, 'chip_id C0300 already exists'))
+
+    def test_import_command(self):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write('chip_id,asset_no,work_order_no,approval_no,product_category\n'
+                    'C1,A1,WO1,AP1,cat1\nC2,A2,WO1,AP1,cat1\n')
+        try:
+            runner = self.app.test_cli_runner()
+            result = runner.invoke(args=['chipid', 'import', path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('2 inserted, 0 updated, 0 skipped', result.output)
+            result = runner.invoke(args=['chipid', 'import', path, '--skip-existing'])
+            self.assertIn('0 inserted, 0 updated, 2 skipped', result.output)
+        finally:
+            os.remove(path)
+
+    def test_lookup(self):
+        self.app.config['CHIPID_LOOKUP_MAX'] = 5
+        ChipImporter().run(read_csv(io.StringIO(
+            'chip_id,asset_no,work_order_no,approval_no,product_category\n' + ''.join(
+                'C{0},A{0},WO1,AP1,cat1\n'.format(i) for i in range(3)))))
+        client = self.app.test_client()
+        response = client.post('/chipid_lookup', json={'by': 'asset_no', 'values': ['A2', 'nope', 'A0']})
+        self.assertEqual(response.get_json(), {'by': 'asset_no', 'unmatched': ['nope'], 'matches': [
+            {'chip_id': 'C2', 'asset_no': 'A2', 'work_order_no': 'WO1', 'approval_no': 'AP1',
+             'product_category': 'cat1'},
+            {'chip_id': 'C0', 'asset_no': 'A0', 'work_order_no': 'WO1', 'approval_no': 'AP1',
+             'product_category': 'cat1'}]})
+        response = client.post('/chipid_lookup', data={
+            'values': 'C1, nope\nC0', 'file': (io.BytesIO(b'chip_id\nC1\nC9\n'), 'ids.txt')})
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.get_data(as_text=True).splitlines(), [
+            'query,chip_id,asset_no,work_order_no,approval_no,product_category',
+            'C1,C1,A1,WO1,AP1,cat1', 'C0,C0,A0,WO1,AP1,cat1', 'nope,,,,,', 'C9,,,,,'])
+        response = client.post('/chipid_lookup', json={'values': ['C{}'.format(i) for i in range(6)]})
+        self.assertEqual(response.status_code, 413)
+        for body in (['C1'], 'C1', 1, {'values': 'C1'}, {'values': [['C1']]}, {'values': [{'a': 1}]}, {}):
+            self.assertEqual(client.post('/chipid_lookup', json=body).status_code, 400, body)
+
+    def test_results_cache(self):
+        def load(rows):
+            ChipImporter().run(read_csv(io.StringIO(
+                'chip_id,asset_no,work_order_no,approval_no,product_category\n' + rows)))
+
+        def results(field_query):
+            return self.client.get('/chipid_results?method_query=2&product_category=cat1&field_query='
+                                   + field_query).get_data(as_text=True)
+
+        load('C1,A1,WO1,AP1,cat1\nC2,A2,WO1,AP1,cat1\n')
+        self.client = self.app.test_client()
+        self.assertIn('C2', results('WO1'))
+        self.assertIn('C2', results('WO1'))
+        stats = chip_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # moving C2 to another work order invalidates both numbers
+        load('C2,A2,WO2,AP1,cat1\n')
+        self.assertNotIn('C2', results('WO1'))
+        self.assertIn('C2', results('WO2'))
+        self.assertEqual(chip_cache.stats()['misses'], 3)
+
+        # with a shared cache too, and without a number to look for
+        chip_cache.cache.shared = FakeSharedCache()
+        self.assertEqual(self.client.get('/chipid_results?method_query=1').status_code, 200)
+        self.assertIn('C2', results('WO2'))
+        load('C2,A2,WO3,AP1,cat1\n')
+        self.assertNotIn('C2', results('WO2'))
+
+        # another process' import, such as flask chipid import, is seen through the stored versions
+        chip_cache.cache.versions.ttl = 0
+        chip_cache.cache.versions.clear()
+        self.assertIn('C2', results('WO3'))
+        with db.engine.begin() as connection:
+            connection.execute(ChipId.__table__.update().where(ChipId.__table__.c.chip_id == 'C2').values(
+                work_order_no_id=WorkOrderNo.query.filter_by(work_order_no='WO1').first().id))
+            connection.execute(chipid_versions.update().where(chipid_versions.c.value.in_(['WO1', 'WO3'])).values(
+                version=chipid_versions.c.version + 1))
+        self.assertNotIn('C2', results('WO3'))
+        self.assertIn('C2', results('WO1'))
+
+    def test_partial_numbers(self):
+        def load(rows):
+            ChipImporter().run(read_csv(io.StringIO(
+                'chip_id,asset_no,work_order_no,approval_no,product_category\n' + rows)))
+
+        def results(method, field_query):
+            return self.client.get('/chipid_results?product_category=cat1&method_query={}&field_query={}'.format(
+                method, field_query)).get_data(as_text=True)
+
+        load('C1,A1,WO2020001,AP00123456,cat1\nC2,A2,WO2020002,AP00999456,cat1\nC3,A3,WO2021001,AP00123457,cat1\n')
+        self.client = self.app.test_client()
+        self.assertIn('C1', results(1, '123456'))
+        self.assertNotIn('C2', results(1, '123456'))
+        ambiguous = results(1, '456')
+        self.assertIn('field_query=AP00123456', ambiguous)
+        self.assertIn('field_query=AP00999456', ambiguous)
+        self.assertNotIn('C1', ambiguous)
+        self.assertIn('C3', results(2, 'WO2021'))
+        self.assertIn('field_query=WO2020002', results(2, 'WO2020'))
+        self.assertIn('C2', results(2, '0002'))
+        self.assertNotIn('C1', results(1, '999999'))
+
+        # numbers imported later are matched too
+        load('C4,A4,WO2022001,AP00777777,cat1\n')
+        self.assertIn('C4', results(1, '777'))
+        self.assertEqual(chip_cache.match(ApprovalNo, 'approval_no', 'AP001', 1), ['AP00123456'])
+
+        # other processes' numbers are found, even when their ids commit out of order
+        self.app.config['CHIPID_NUMBER_CHECK_INTERVAL'] = 0
+        table = ApprovalNo.__table__
+        db.session.execute(table.insert().values(id=100, approval_no='AP00555100'))
+        db.session.commit()
+        self.assertEqual(chip_cache.match(ApprovalNo, 'approval_no', '555100', 5), ['AP00555100'])
+        db.session.execute(table.insert().values(id=50, approval_no='AP00555050'))
+        db.session.commit()
+        self.assertEqual(chip_cache.match(ApprovalNo, 'approval_no', 'AP00555', 5), ['AP00555050', 'AP00555100'])
+
+    def test_export(self):
+        ChipImporter().run(read_csv(io.StringIO(
+            'chip_id,asset_no,work_order_no,approval_no,product_category\n' + ''.join(
+                'C{0},A{0},WO{1},AP1,cat{2}\n'.format(i, i % 2, i % 3) for i in range(6)))))
+        client = self.app.test_client()
+        response = client.get('/chipid_results?format=csv&method_query=2&field_query=WO0'
+                              '&product_category=cat0&product_category=cat2')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertIn('chipid_WO0.csv', response.headers['Content-Disposition'])
+        self.assertEqual(response.get_data(as_text=True).lstrip('\ufeff').splitlines(), [
+            'chip_id,asset_no,work_order_no,approval_no,product_category',
+            'C0,A0,WO0,AP1,cat0', 'C2,A2,WO0,AP1,cat2'])
+        response = client.get('/chipid_results?format=csv&method_query=2&field_query=工单 "1";x')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Disposition'], 'attachment; filename="chipid____1_x.csv"; '
+                         'filename*=UTF-8\'\'chipid_%E5%B7%A5%E5%8D%95_1_x.csv')
+        response.close()
+
+
+class ViewCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username, password='cat'):
+        return self.client.post('/auth/login', data={'username': username, 'password': password})
+
+    def count_queries(self, url, status=200, **kwargs):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url, **kwargs)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(response.status_code, status)
+        return len(statements)
+
+    def test_post_list_query_count(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(12)]
+        users[0].set_password('cat')
+        now = datetime.utcnow()
+        db.session.add_all(users + [Post(body='post {}'.format(i), author=user,
+                                         timestamp=now + timedelta(seconds=i))
+                                    for i, user in enumerate(users)])
+        db.session.commit()
+        for user in users[1:]:
+            users[0].follow(user)
+        db.session.commit()
+        self.login('user0')
+
+        # authors are loaded with the page, so the number of queries does not
+        # depend on how many different authors are shown; the home page also
+        # reads the who-to-follow suggestions and their version
+        self.assertEqual(self.count_queries('/explore'), 3)
+        self.assertEqual(self.count_queries('/index'), 4)
+
+    def test_page_cache(self):
+        john = User(username='john', email='john@example.com')
+        john.set_password('cat')
+        db.session.add_all([john, Post(body='first post', author=john)])
+        db.session.commit()
+        self.login('john')
+
+        self.assertIn('first post', self.client.get('/explore').get_data(as_text=True))
+        self.assertIn('first post', self.client.get('/user/john').get_data(as_text=True))
+        stats = page_cache.stats()
+        self.assertEqual((stats['posts']['hits'], stats['posts']['misses']), (1, 1))
+        self.assertLess(self.count_queries('/explore'), 4)
+
+        # a new post shows up on the next request, and the full cache evicts
+        self.app.extensions['page_cache']['posts'].size = 1
+        self.client.post('/index', data={'post': 'second post'})
+        self.assertIn('second post', self.client.get('/explore').get_data(as_text=True))
+        self.assertEqual(page_cache.stats()['posts']['size'], 1)
+        self.assertGreater(page_cache.stats()['posts']['evictions'], 0)
+
+        # a post written by another process does not clear this process' cache, but misses it
+        with db.engine.begin() as connection:
+            connection.execute(Post.__table__.insert().values(
+                body='third post', user_id=john.id, timestamp=datetime.utcnow() + timedelta(seconds=1)))
+        self.assertIn('third post', self.client.get('/explore').get_data(as_text=True))
+
+    def test_conditional_get(self):
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        john.set_password('cat')
+        db.session.add_all([john, susan, Post(body='first post', author=susan)])
+        db.session.commit()
+        self.login('john')
+        self.client.get('/index')  # the login flash
+
+        for url in ('/index', '/explore', '/user/susan'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+            # only the validator runs, not the page's queries
+            self.assertLessEqual(self.count_queries(url, 304, headers={'If-None-Match': etag}), 3)
+        modified = self.client.get('/explore').headers['Last-Modified']
+        self.assertEqual(self.client.get('/explore', headers={'If-Modified-Since': modified}).status_code, 304)
+
+        # following changes the profile and home pages, a post changes every page
+        profile = self.client.get('/user/susan').headers['ETag']
+        self.client.get('/follow/susan')
+        self.client.get('/user/susan')  # the flash
+        self.assertEqual(self.client.get('/user/susan', headers={'If-None-Match': profile}).status_code, 200)
+        explore = self.client.get('/explore').headers['ETag']
+        db.session.add(Post(body='second post', author=susan))
+        db.session.commit()
+        self.assertEqual(self.client.get('/explore', headers={'If-None-Match': explore}).status_code, 200)
+
+        # so does renaming an author of the posts shown
+        explore = self.client.get('/explore').headers['ETag']
+        susan.username = 'susanna'
+        db.session.commit()
+        response = self.client.get('/explore', headers={'If-None-Match': explore})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('susanna', response.get_data(as_text=True))
+
+        # a new username changes every page that greets the viewer
+        home = self.client.get('/index').headers['ETag']
+        self.client.post('/edit_profile', data={'username': 'johnny', 'about_me': ''})
+        self.client.get('/index')  # the flash
+        self.assertEqual(self.client.get('/index', headers={'If-None-Match': home}).status_code, 200)
+
+    def test_metrics(self):
+        john = User(username='john', email='john@example.com')
+        john.set_password('cat')
+        db.session.add(john)
+        db.session.commit()
+        self.login('john')
+        self.app.config['METRICS_SLOW_QUERY'] = 0
+        queries = self.count_queries('/explore') + self.count_queries('/explore')
+        self.client.get('/user/nobody')
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_request_duration_seconds_count{endpoint="main.explore",method="GET"} 2', text)
+        self.assertIn('microblog_request_duration_seconds_bucket{endpoint="main.explore",method="GET",le="+Inf"} 2',
+                      text)
+        self.assertIn('microblog_requests_total{endpoint="main.user",method="GET",status="404"} 1', text)
+        self.assertIn('microblog_db_queries_total{{endpoint="main.explore"}} {}'.format(queries), text)
+        self.assertIn('microblog_db_seconds_total{endpoint="main.explore"}', text)
+        slow = self.client.get('/metrics/slow_queries').get_json()['slow_queries']
+        self.assertIn('main.explore', [sample['endpoint'] for sample in slow])
+        self.assertTrue(all(sample['statement'] for sample in slow))
+
+        # a failing statement leaves nothing behind on its connection
+        with db.engine.connect() as connection:
+            with self.assertRaises(Exception):
+                connection.execute('SELECT * FROM no_such_table')
+            self.assertEqual(connection.info, {})
+
+        # without a token only local, unproxied requests are answered
+        self.assertEqual(self.client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code, 403)
+        self.assertEqual(self.client.get('/metrics/slow_queries', headers={'X-Forwarded-For': '10.0.0.1'}).status_code,
+                         403)
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code, 200)
+
+    def test_static_assets(self):
+        with self.app.test_request_context():
+            self.assertEqual(url_for('static', filename='style.css'), '/static/style.css')
+        self.app.config['ASSETS_BUILD_DIR'] = tempfile.mkdtemp()
+        try:
+            result = self.app.test_cli_runner().invoke(args=['assets', 'build'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            assets.load(self.app)
+            files = self.app.extensions['assets']['files']
+            self.assertFalse([name for name in files.values() if name.endswith('.map')])
+            # only the minified copy of bootstrap is shipped
+            self.assertTrue(files['css/bootstrap.css'].startswith('css/bootstrap.min.'))
+            with open(os.path.join(self.app.config['ASSETS_BUILD_DIR'], files['css/fonts.css'])) as f:
+                self.assertIn(os.path.basename(files['fonts/glyphicons-halflings-regular.woff2']), f.read())
+
+            with self.app.test_request_context():
+                url = url_for('static', filename='style.css')
+            self.assertEqual(url, '/static/' + files['style.css'])
+            self.assertIn(url, self.client.get('/auth/login').get_data(as_text=True))
+            response = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.mimetype, 'text/css')
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            with open(os.path.join(self.app.static_folder, 'style.css'), 'rb') as f:
+                self.assertEqual(gzip.decompress(response.get_data()), f.read())
+            response = self.client.get(url)
+            self.assertNotIn('Content-Encoding', response.headers)
+            response.close()
+            response = self.client.get(url, headers={'Accept-Encoding': 'gzip;q=0, identity'})
+            self.assertNotIn('Content-Encoding', response.headers)
+            response.close()
+            response = self.client.get('/static/style.css')
+            self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+            response.close()
+        finally:
+            shutil.rmtree(self.app.config['ASSETS_BUILD_DIR'])
+
+        # stylesheets that import each other are built once each
+        directory = tempfile.mkdtemp()
+        try:
+            for name, content in (('a.css', '@import url(b.css);'), ('b.css', '@import url("a.css");'),
+                                  ('page.html', "{{ url_for('static', filename='a.css') }}")):
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(content)
+            files = build(directory, [directory], os.path.join(directory, 'build'))['files']
+            self.assertEqual(sorted(files), ['a.css', 'b.css'])
+            with open(os.path.join(directory, 'build', files['a.css'])) as f:
+                self.assertEqual(f.read(), '@import url({});'.format(files['b.css']))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_benchmark(self):
+        results = benchmark.run(scale=0.01, requests=3, warmup=1)
+        self.assertEqual(results['data']['users'], 10)
+        self.assertEqual(set(results['scenarios']), {
+            'index', 'explore', 'user', 'search', 'chipid_results_work_order', 'chipid_results_approval',
+            'chipid_results_csv'})
+        for result in results['scenarios'].values():
+            self.assertEqual(result['errors'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['queries_per_request'], 0)
+        self.assertEqual(benchmark.compare(results, results)[0].count('(+0%)'), 5)
+
+    def test_import_time(self):
+        # heavy optional clients are imported on first use, not by create_app
+        env = dict(os.environ, SEARCH_SQLITE_PATH=':memory:', LOG_TO_STDOUT='true',
+                   ELASTICSEARCH_URL='http://localhost:9200', MAIL_TRANSPORT='sendgrid')
+        # flask first, so that the time of `import app` is what the app adds on top of it
+        script = 'import flask; import app; app.create_app()'
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, check=True).stderr.decode()
+        modules = {line.split('|')[2].strip(): int(line.split('|')[1]) for line in output.splitlines()
+                   if line.startswith('import time:') and line.split('|')[1].strip().isdigit()}
+        self.assertNotIn('elasticsearch', modules)
+        self.assertNotIn('sendgrid', modules)
+        self.assertLess(modules['app'], IMPORT_TIME_BUDGET * modules['flask'])
+
+        self.app.config['ELASTICSEARCH_URL'] = 'http://localhost:9200'
+        self.assertIsNone(self.app.elasticsearch)
+        client = elasticsearch_client(self.app)
+        self.assertIsNotNone(client)
+        self.assertIs(elasticsearch_client(self.app), client)
+
+    def test_timeline_stream(self):
+        john, susan, mary = [User(username=name, email='{}@example.com'.format(name))
+                             for name in ('john', 'susan', 'mary')]
+        john.set_password('cat')
+        db.session.add_all([john, susan, mary])
+        db.session.commit()
+        john.follow(susan)
+        db.session.add(Post(body='missed post', author=susan))
+        db.session.commit()
+        missed = Post.query.first().id
+        self.login('john')
+        self.app.config['STREAM_HEARTBEAT'] = 0.01
+
+        response = self.client.get('/stream/timeline', headers={'Last-Event-ID': str(missed - 1)})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.response
+        self.assertEqual(next(events), b'retry: 3000\n\n')
+        # the open stream holds no session, and so no pooled connection
+        self.assertFalse(db.session.registry.has())
+        self.assertIn(b'missed post', next(events))
+        self.assertEqual(next(events), b': keep-alive\n\n')
+
+        db.session.add_all([Post(body='not followed', author=mary), Post(body='live post', author=susan)])
+        db.session.commit()
+        event = next(events).decode('utf-8')
+        self.assertTrue(event.startswith('id: {}\nevent: post\ndata: '.format(missed + 2)))
+        self.assertIn('live post', event)
+        self.assertEqual(self.app.extensions['timeline_stream'].connections, 1)
+        response.close()
+        self.assertEqual(self.app.extensions['timeline_stream'].connections, 0)
+
+    def test_password_reset_email(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.client.post('/auth/reset_password_request', data={'email': 'john@example.com'})
+        self.client.post('/auth/reset_password_request', data={'email': 'nobody@example.com'})
+        outbox = transport().outbox
+        self.assertEqual([message['to'] for message in outbox], ['john@example.com'])
+        self.assertIn('/auth/reset_password/', outbox[0]['text'])
+        self.assertEqual(jobs.stats()['queue'], {})
+
+    def test_sendgrid_batch(self):
+        requests = []
+
+        class Refused(Exception):
+            status_code = 400
+
+        class Client(object):
+            def send(self, message):
+                requests.append(message)
+                if message['from']['email'] == 'refused@example.com':
+                    raise Refused()
+
+        sender = SendGridTransport.__new__(SendGridTransport)
+        sender.client = Client()
+        messages = [{'from': 'no-reply@example.com', 'to': 'user{}@example.com'.format(i),
+                     'subject': 'Hello {}'.format(i), 'text': 'text {}'.format(i), 'html': '<p>{}</p>'.format(i)}
+                    for i in range(3)]
+        messages.append(dict(messages[0], **{'from': 'refused@example.com'}))
+        results = sender.send_batch(messages)
+        # one request per sender, with the messages as personalizations
+        self.assertEqual(len(requests), 2)
+        self.assertEqual([p['to'][0]['email'] for p in requests[0]['personalizations']],
+                         ['user0@example.com', 'user1@example.com', 'user2@example.com'])
+        self.assertEqual(requests[0]['personalizations'][1]['subject'], 'Hello 1')
+        self.assertEqual(requests[0]['personalizations'][1]['substitutions'],
+                         {'-text-': 'text 1', '-html-': '<p>1</p>'})
+        self.assertEqual(results[:3], [None, None, None])
+        self.assertIsInstance(results[3], PermanentError)
+
+    def test_job_retries(self):
+        calls = []
+
+        @jobs.handler('test')
+        def handler(payloads):
+            calls.append(payloads)
+            return [None if payload['ok'] else (PermanentError('bad') if payload['ok'] is None else
+                                                 ValueError('later')) for payload in payloads]
+
+        self.app.config['JOBS_MAX_ATTEMPTS'] = 2
+        for ok in (True, False, None):
+            jobs.enqueue('test', {'ok': ok})
+        db.session.commit()
+        self.assertEqual(len(calls[0]), 3)
+        self.assertEqual(jobs.stats()['queue'], {'test': {'failed': 1, 'pending': 1}})
+        self.assertEqual(jobs.worker.work_once(), 0)  # backing off
+        db.session.execute(job.update().values(run_at=datetime.utcnow()))
+        db.session.commit()
+        self.assertEqual(jobs.worker.work_once(), 1)
+        self.assertEqual(jobs.stats()['queue'], {'test': {'failed': 2}})
+        self.assertEqual(db.session.query(job.c.attempts, job.c.last_error).order_by(job.c.id).all(),
+                         [(2, 'later'), (1, 'bad')])
+        metrics = jobs.stats()['worker']
+        self.assertEqual((metrics['test.done'], metrics['test.retried'], metrics['test.failed']), (1, 1, 2))
+
+    def test_logging(self):
+        self.app.config['LOG_FILE'] = os.path.join(tempfile.mkdtemp(), 'logs', 'microblog.log')
+        listener = init_logging(self.app)
+        queue_handler = self.app.logger.handlers[-1]
+        # warnings and errors still go to stderr next to the log file
+        self.assertEqual([handler.level for handler in listener.handlers if
+                          isinstance(handler, logging.StreamHandler) and handler.stream is sys.stderr],
+                         [logging.WARNING])
+        try:
+            with self.app.test_request_context('/explore?page=2'):
+                try:
+                    1 / 0
+                except ZeroDivisionError:
+                    self.app.logger.exception('Explore failed for %s', 'john')
+            listener.stop()
+            for i in range(self.app.config['LOG_QUEUE_SIZE'] + 2):
+                self.app.logger.info('flood')
+            self.assertEqual(queue_handler.dropped, 2)
+            listener.start()
+            listener.stop()
+            self.app.logger.info('after the flood')
+            listener.start()
+            listener.stop()
+        finally:
+            self.app.logger.removeHandler(queue_handler)
+        with open(self.app.config['LOG_FILE']) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0]['message'], 'Explore failed for john')
+        self.assertEqual(lines[0]['request'], {'method': 'GET', 'path': '/explore?page=2', 'remote_addr': None})
+        self.assertIn('ZeroDivisionError', lines[0]['exc_text'])
+        self.assertTrue(lines[0]['fingerprint'])
+        self.assertIn('2 log records were dropped', lines[-2]['message'])
+        self.assertEqual(lines[-1]['message'], 'after the flood')
+
+    def test_error_mail_throttling(self):
+        sent = []
+
+        class Handler(ThrottledSMTPHandler):
+            def emit(self, record):
+                sent.append(self.getSubject(record))
+
+        handler = Handler('localhost', 'no-reply@localhost', ['admin@localhost'], 'Failure', window=600, limit=2)
+
+        def fail(error):
+            try:
+                raise error
+            except Exception:
+                return logging.makeLogRecord({'levelno': logging.ERROR, 'msg': 'failed',
+                                              'exc_info': sys.exc_info()})
+
+        for i in range(3):
+            handler.handle(fail(ValueError()))
+        handler.handle(fail(KeyError()))
+        handler.handle(fail(TypeError()))
+        self.assertEqual(sent, ['Failure', 'Failure'])
+        handler.sent.clear()
+        handler.last_sent.clear()
+        handler.handle(fail(ValueError()))
+        self.assertEqual(sent[-1], 'Failure (+2 like it)')
+
+        # counts of errors that stopped happening are dropped after the window
+        self.assertEqual(len(handler.suppressed), 1)
+        handler.suppressed = {key: (count, t - 601) for key, (count, t) in handler.suppressed.items()}
+        handler.sent.clear()
+        handler.handle(fail(OSError()))
+        self.assertEqual(handler.suppressed, {})
+
+    def test_last_seen_write_behind(self):
+        self.app.config['LAST_SEEN_FLUSH_COUNT'] = 2
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        last_seen.flush()
+        long_ago = datetime(2020, 1, 1)
+        u1 = User(username='john', email='john@example.com', last_seen=long_ago)
+        u2 = User(username='susan', email='susan@example.com', last_seen=long_ago)
+        u1.set_password('cat')
+        u2.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        # page views are only recorded in memory...
+        self.login('john')
+        self.client.get('/explore')
+        self.client.get('/explore')
+        self.assertEqual(db.session.query(User.last_seen).filter_by(username='john').scalar(),
+                         long_ago)
+
+        # ...until enough users are pending, then they are written in one batch
+        self.client.get('/auth/logout')
+        self.login('susan')
+        self.client.get('/explore')
+        for username in ('john', 'susan'):
+            self.assertGreater(db.session.query(User.last_seen).filter_by(
+                username=username).scalar(), long_ago)
+        self.assertEqual(last_seen.pending, {})
+
+        # recent values are not recorded again
+        last_seen.touch(User.query.filter_by(username='john').first())
+        self.assertEqual(last_seen.pending, {})
+
+        # a failed write keeps the timestamps for the next flush instead of failing the page
+        def locked(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE user'):
+                raise sqlite3.OperationalError('database is locked')
+
+        later = datetime(2030, 1, 1)
+        john = User.query.filter_by(username='john').first()
+        db.event.listen(db.engine, 'before_cursor_execute', locked)
+        try:
+            last_seen.touch(john, later)
+            last_seen.touch(u2, later)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', locked)
+        self.assertEqual(last_seen.pending, {john.id: later, u2.id: later})
+        last_seen.flush()
+        self.assertEqual(db.session.query(User.last_seen).filter_by(username='john').scalar(), later)
+
+
+class ReplicaCase(unittest.TestCase):
+    """A primary and a replica in two SQLite files, replicated by copying on demand."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.primary = os.path.join(self.directory, 'primary.db')
+        self.replica = os.path.join(self.directory, 'replica.db')
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.primary
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + self.replica]
+            SQLALCHEMY_REPLICA_LAG = 0
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        for engine in (db.engine, db.get_engine(bind='replica0')):
+            engine.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def replicate(self):
+        source, target = sqlite3.connect(self.primary), sqlite3.connect(self.replica)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    def test_routing(self):
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        john = User(username='john', email='john@example.com')
+        john.set_password('cat')
+        db.session.add_all([john, Post(body='replicated post', author=john)])
+        db.session.commit()
+        self.replicate()
+        db.session.add(Post(body='unreplicated post', author=john))
+        db.session.commit()
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.client.get('/index')  # the login flash
+
+        # marked views read from the replica, the rest from the primary
+        explore = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('replicated post', explore)
+        self.assertNotIn('unreplicated post', explore)
+        self.assertNotIn('unreplicated post', self.client.get('/user/john').get_data(as_text=True))
+        self.assertIn('unreplicated post', self.client.get('/index').get_data(as_text=True))
+
+        # a writer keeps reading from the primary for a while
+        self.app.config['SQLALCHEMY_REPLICA_LAG'] = 60
+        self.client.post('/index', data={'post': 'fresh post'})
+        profile = self.client.get('/user/john').get_data(as_text=True)
+        self.assertIn('fresh post', profile)
+        self.assertIn('unreplicated post', profile)
+
+        # writes never go to the replica
+        with sqlite3.connect(self.replica) as replica:
+            self.assertEqual(replica.execute('SELECT count(*) FROM post').fetchone()[0], 1)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)